@@ -225,24 +225,22 @@ def fig7():
         st.set_vacuum_wavelength(lam0)
         st.info()
 
-        # Calculate spontaneous emission of layer
-        result = st.calc_spe_structure(th_pow=9)
-        z = result['z']
-        iloc = int((len(z) - 1) / 2)
+        # Calculate spontaneous emission at the centre of the layer only
+        result = st.calc_spe_points([d / 2], th_pow=9)
         leaky = result['leaky']
         try:
             guided = result['guided']
-            te_guided.append(guided['TE'][iloc])
-            tm_guided_p.append(guided['TM_p'][iloc])
-            tm_guided_s.append(guided['TM_s'][iloc])
+            te_guided.append(guided['TE'][0])
+            tm_guided_p.append(guided['TM_p'][0])
+            tm_guided_s.append(guided['TM_s'][0])
         except KeyError:
             te_guided.append(0)
             tm_guided_p.append(0)
             tm_guided_s.append(0)
 
-        te_leaky.append(leaky['TE'][iloc])
-        tm_leaky_p.append(leaky['TM_p'][iloc])
-        tm_leaky_s.append(leaky['TM_s'][iloc])
+        te_leaky.append(leaky['TE'][0])
+        tm_leaky_p.append(leaky['TM_p'][0])
+        tm_leaky_s.append(leaky['TM_s'][0])
 
     # Convert lists to arrays
     d_list = np.array(d_list)
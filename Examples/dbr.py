@@ -33,9 +33,7 @@ def example1():
 
     st = TransferMatrix()
     st.add_layer(0, n_s)
-    for i in range(p):
-        st.add_layer(lam0 / (n_h * 4), n_h)
-        st.add_layer(lam0 / (n_l * 4), n_l)
+    st.add_periodic_layers([lam0 / (n_h * 4), lam0 / (n_l * 4)], [n_h, n_l], p)
     st.add_layer(lam0 / (n_h * 4), n_h)
 
     st.set_vacuum_wavelength(lam0)
@@ -58,9 +56,7 @@ def example2():
     # Setup simulation
     st = TransferMatrix()
     st.add_layer(0, n_s)
-    for i in range(p):
-        st.add_layer(lam0 / (n_h * 4), n_h)
-        st.add_layer(lam0 / (n_l * 4), n_l)
+    st.add_periodic_layers([lam0 / (n_h * 4), lam0 / (n_l * 4)], [n_h, n_l], p)
     st.add_layer(lam0 / (n_h * 4), n_h)
 
     st.set_vacuum_wavelength(lam0)
@@ -196,8 +196,34 @@ def example3():
     plt.show()
 
 
+def example4():
+    """Guided modes of a silicon slab with a thick (200 um) air cladding, which match those of a 20 um cladding
+    (the evanescent tails have long decayed) in both formalisms."""
+    import numpy as np
+    from scipy.constants import c
+    from lifetmm.TransferMatrix import TransferMatrix
+
+    for formalism in ['transfer', 'scattering']:
+        modes = []
+        for d_clad in [20e3, 200e3]:
+            st = TransferMatrix()
+            st.add_layer(0, 1.45)
+            st.add_layer(300, 3.48)
+            st.add_layer(d_clad, 1)
+            st.add_layer(0, 1.45)
+            st.set_vacuum_wavelength(1540)
+            st.set_formalism(formalism)
+            n_11 = st.calc_guided_modes(verbose=False, normalised=True)
+            print('{} formalism, {:g} um cladding: n_11 = {}, v_g/c = {}'
+                  .format(formalism, d_clad / 1e3, n_11, st.calc_group_velocity(n_11) / c))
+            modes.append(n_11)
+        assert len(modes[0]) == len(modes[1]) == 2 and np.allclose(modes[0], modes[1]), \
+            ValueError('Guided modes lost for the thick cladding.')
+
+
 if __name__ == "__main__":
     SAVE = False
     # example1()
     # example2()
     example3()
+    # example4()
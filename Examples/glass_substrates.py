@@ -20,7 +20,8 @@ def plot_rates(d, n, n_sub, title):
     st.info()
 
     # Calculate
-    res = st.calc_spe_structure(th_pow=11)
+    # Rates vs z and exact layer averages in one pass
+    res = st.calc_spe_structure_with_averages(th_pow=11)
     z = res['z']
 
     # Convert z into z/lam0 and center
@@ -33,12 +34,13 @@ def plot_rates(d, n, n_sub, title):
         ax1.plot(z, res['leaky']['avg'] + res['guided']['avg'], label='Avg')
         ax1.plot(z, res['leaky']['parallel'] + res['guided']['parallel'], '--', label=r'$\parallel$')
         ax1.plot(z, res['leaky']['perpendicular'] + res['guided']['perpendicular'], '-.', label=r'$\bot$')
-        fp = np.mean(res['leaky']['avg'] + res['guided']['avg'])
     else:
         ax1.plot(z, res['leaky']['avg'], label='Avg')
         ax1.plot(z, res['leaky']['parallel'], '--', label=r'$\parallel$')
         ax1.plot(z, res['leaky']['perpendicular'], '-.', label=r'$\bot$')
-        fp = np.mean(res['leaky']['avg'])
+    # Average rate over the structure (thickness weighted exact layer averages)
+    layers = res['average']
+    fp = np.sum(st.d_list[layers['layer']] * layers['total']) / np.sum(st.d_list)
     ax1.set_ylabel('$\Gamma / \Gamma_0$')
     ax1.set_xlabel('Position z [$\lambda$]')
     ax1.legend(fontsize='small')
@@ -0,0 +1,178 @@
+import functools
+import glob
+import hashlib
+import inspect
+import logging
+import os
+import pickle
+
+import numpy as np
+
+from lifetmm.HelperFunctions import atomic_write
+
+log = logging.getLogger(__name__)
+
+# Arguments that don't change the results of the cached methods
+_IGNORED_ARGUMENTS = ('self', 'verbose', 'workers')
+
+
+class ResultCache:
+    """
+    On-disk cache of results, pickled to <path>/<key>.pkl, holding at most max_size bytes by deleting the least
+    recently used results.
+    """
+
+    def __init__(self, path=None, max_size=2 ** 30):
+        self.path = os.path.join(os.path.expanduser('~'), '.cache', 'lifetmm') if path is None else path
+        self.max_size = max_size
+        os.makedirs(self.path, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        """ Return the hash of the parts (arrays, dicts, lists, tuples and scalars) and the lifetmm source code. """
+        h = hashlib.sha256(code_version().encode())
+        _update_hash(h, parts)
+        return h.hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.pkl')
+
+    def get(self, key):
+        """ Return (True, result) if the key is in the cache, otherwise (False, None). """
+        filename = self._file(key)
+        try:
+            with open(filename, 'rb') as f:
+                result = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return False, None
+        # Mark as recently used
+        os.utime(filename)
+        return True, result
+
+    def put(self, key, result):
+        """ Store the result under key, then evict the least recently used results beyond max_size. """
+        atomic_write(self._file(key), lambda f: pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL))
+        self.evict()
+
+    def evict(self):
+        """ Delete the least recently used results until the cache holds at most max_size bytes. """
+        files = []
+        for filename in glob.glob(os.path.join(self.path, '*.pkl')):
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, filename))
+        size = sum(item[1] for item in files)
+        for _, file_size, filename in sorted(files):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            size -= file_size
+
+    def clear(self):
+        """ Delete all the cached results. """
+        for filename in glob.glob(os.path.join(self.path, '*.pkl')):
+            os.remove(filename)
+
+    def size(self):
+        """ Return the total size of the cached results in bytes. """
+        return sum(os.path.getsize(filename) for filename in glob.glob(os.path.join(self.path, '*.pkl')))
+
+
+_cache = None
+
+
+def enable_cache(path=None, max_size=2 ** 30):
+    """
+    Cache the results of the methods decorated with cached in path (default ~/.cache/lifetmm), bounded to
+    max_size bytes. Also enabled on import if the environment variable LIFETMM_CACHE holds a path.
+    Returns the ResultCache.
+    """
+    global _cache
+    _cache = ResultCache(path, max_size)
+    return _cache
+
+
+def disable_cache():
+    global _cache
+    _cache = None
+
+
+def get_cache():
+    """ Return the enabled ResultCache or None. """
+    return _cache
+
+
+def structure_state(st, light=()):
+    """
+    Return the parameters that define the results of a structure: the class, the layer stack, the wavelength
+    and the matrix formalism, plus the light parameters named in light (e.g. 'pol' and 'field').
+    """
+    return (type(st).__name__, st.d_list, st.n_list, st.periods, st.lam_vac, st.formalism) + \
+        tuple(getattr(st, name) for name in light)
+
+
+def cached(method=None, light=()):
+    """
+    Decorator of the structure methods whose results are stored in the enabled cache (see enable_cache), keyed
+    on the method, structure_state(light) and the method arguments (except verbose and workers). Use
+    @cached(light=(...)) for methods that read light parameters of the structure.
+    """
+    if method is None:
+        return functools.partial(cached, light=light)
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        cache = get_cache()
+        if cache is None:
+            return method(self, *args, **kwargs)
+        arguments = signature.bind(self, *args, **kwargs)
+        arguments.apply_defaults()
+        arguments = {name: value for name, value in arguments.arguments.items() if name not in _IGNORED_ARGUMENTS}
+        key = cache.key(method.__qualname__, structure_state(self, light), arguments)
+        hit, result = cache.get(key)
+        if hit:
+            logging.info('{}: result loaded from the cache.'.format(method.__qualname__))
+            return result
+        result = method(self, *args, **kwargs)
+        cache.put(key, result)
+        return result
+
+    return wrapper
+
+
+@functools.lru_cache(maxsize=None)
+def code_version():
+    """ Return the hash of the lifetmm source code, so that results of older versions are not reused. """
+    h = hashlib.sha256()
+    for filename in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), '*.py'))):
+        with open(filename, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def _update_hash(h, obj):
+    # Feed obj into the hash h, with its type so that e.g. 1, 1.0 and '1' differ
+    if isinstance(obj, dict):
+        h.update(b'dict')
+        for key in sorted(obj, key=repr):
+            _update_hash(h, key)
+            _update_hash(h, obj[key])
+    elif isinstance(obj, (list, tuple)):
+        h.update(type(obj).__name__.encode() + str(len(obj)).encode())
+        for item in obj:
+            _update_hash(h, item)
+    elif isinstance(obj, np.ndarray):
+        h.update('ndarray{}{}'.format(obj.dtype.str, obj.shape).encode())
+        h.update(np.ascontiguousarray(obj).tobytes())
+    else:
+        h.update('{}{!r}'.format(type(obj).__name__, obj).encode())
+
+
+if os.environ.get('LIFETMM_CACHE'):
+    enable_cache(os.environ['LIFETMM_CACHE'])
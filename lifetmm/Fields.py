@@ -0,0 +1,194 @@
+import logging
+import warnings
+
+import numpy as np
+from numpy import exp, conj
+
+from lifetmm.HelperFunctions import sinc
+
+log = logging.getLogger(__name__)
+
+
+def locate_z(d_list, z):
+    """
+    Return the layer of each of the positions z (measured from the bottom of the structure with layer
+    thicknesses d_list) and the position relative to the lower boundary of that layer. Positions in the lower
+    cladding are negative (measured from the first boundary) and positions beyond the structure are in the
+    semi-infinite claddings.
+    """
+    d_cumulative = np.cumsum(d_list)
+    # z_mat - specifies what layer the corresponding point in z is in
+    z_mat = np.minimum(np.searchsorted(d_cumulative, z, side='left'), len(d_list) - 1)
+    z_local = z - np.append(d_cumulative[0], d_cumulative[:-1])[z_mat]
+    return z_mat, z_local
+
+
+def layer_interval(d_list, layer):
+    """
+    Return the centre and the thickness of layer (or an array of layers) in the local coordinates of
+    locate_z, i.e. d/2 and d, or -d/2 and d for the lower cladding.
+    """
+    d = np.asarray(d_list)[layer]
+    return np.where(np.asarray(layer) == 0, -d / 2, d / 2), d
+
+
+def mean_squared(a, b, q, z, dz):
+    """
+    Mean of |a * exp(iqz') + b * exp(-iqz')|^2 over z' in [z - dz/2, z + dz/2], in closed form:
+
+        sinc((q - q*) dz/2) (|a|^2 exp(i(q - q*)z) + |b|^2 exp(-i(q - q*)z))
+            + 2 Re(a b* exp(i(q + q*)z) sinc((q + q*) dz/2))
+
+    where sinc(x) = sin(x) / x. With dz = 0 this is |field(z)|^2. All the arguments broadcast together.
+    """
+    q_minus, q_plus = q - conj(q), q + conj(q)
+    with np.errstate(over='ignore', invalid='ignore'):
+        # Terms without amplitude (e.g. evanescent waves growing into a cladding) vanish at any depth
+        fwd = np.where(a == 0, 0, abs(a) ** 2 * exp(1j * q_minus * z))
+        bkwd = np.where(b == 0, 0, abs(b) ** 2 * exp(-1j * q_minus * z))
+    cross = a * conj(b) * exp(1j * q_plus * z) * sinc(q_plus * dz / 2)
+    return np.real(sinc(q_minus * dz / 2) * (fwd + bkwd) + 2 * cross)
+
+
+def depth_quadrature(d_list, density, layer=None, z_range=None, num=32, tol=1e-4, max_depth=16):
+    """
+    Quadrature nodes z and weights (summing to 1) to average a quantity over an emitter depth profile, i.e.
+    sum(weights * f(z)) = int density(z) f(z) dz / int density(z) dz, with z measured from the bottom of the
+    structure with layer thicknesses d_list (as locate_z).
+
+    density is either a vectorized function density(z), or a tabulated (e.g. measured) profile (z, density)
+    which is interpolated linearly and zero outside of its points. The profile is averaged over layer, the range
+    z_range = (z_lower, z_upper), the range of the tabulated points or the whole structure, with num
+    Gauss-Legendre nodes in each layer within the range (the fields are smooth within each layer but kinked at
+    the interfaces). Segments are halved (at most max_depth times) until the integral of the density over them
+    agrees with the sum over their halves to tol (relative to the total), so narrow profiles get their nodes.
+    """
+    if not callable(density):
+        z_table, rho_table = (np.asarray(x, dtype=float) for x in density)
+        assert z_table.ndim == 1 and z_table.shape == rho_table.shape and len(z_table) > 1, \
+            ValueError('Tabulated profile must be a tuple of two 1D arrays (z, density) of the same length.')
+        assert np.all(np.diff(z_table) > 0), ValueError('Tabulated z must be increasing.')
+        if layer is None and z_range is None:
+            z_range = z_table[0], z_table[-1]
+
+        def density(z):
+            return np.interp(z, z_table, rho_table, left=0, right=0)
+
+    d_cumulative = np.cumsum(d_list)
+    bounds = np.append(0, d_cumulative)
+    if layer is not None:
+        z_range = bounds[layer], bounds[layer + 1]
+    elif z_range is None:
+        z_range = 0, d_cumulative[-1]
+    assert z_range[1] > z_range[0], ValueError('z_range must be (z_lower, z_upper) with z_upper > z_lower.')
+    # Split the range at the interfaces
+    edges = np.unique(np.clip(np.concatenate((z_range, d_cumulative[:-1])), *z_range))
+    x, w = np.polynomial.legendre.leggauss(num)
+
+    def segments(lower, upper):
+        # Nodes and density weighted weights of each segment along the rows
+        z = (upper + lower)[:, None] / 2 + (upper - lower)[:, None] / 2 * x
+        return z, (upper - lower)[:, None] / 2 * w * np.asarray(density(z.ravel()), dtype=float).reshape(z.shape)
+
+    lower, upper = edges[:-1], edges[1:]
+    z, weights = segments(lower, upper)
+    nodes = []
+    for depth in range(max_depth + 1):
+        middle = (lower + upper) / 2
+        z_lower, w_lower = segments(lower, middle)
+        z_upper, w_upper = segments(middle, upper)
+        halves = np.sum(w_lower, axis=1) + np.sum(w_upper, axis=1)
+        total = np.sum(halves) + sum(np.sum(item[1]) for item in nodes)
+        done = (abs(np.sum(weights, axis=1) - halves) <= tol * total) | (depth == max_depth)
+        nodes.append((z[done], weights[done]))
+        if np.all(done):
+            break
+        lower, upper = np.append(lower[~done], middle[~done]), np.append(middle[~done], upper[~done])
+        z, weights = np.vstack((z_lower[~done], z_upper[~done])), np.vstack((w_lower[~done], w_upper[~done]))
+    z = np.concatenate([item[0].ravel() for item in nodes])
+    weights = np.concatenate([item[1].ravel() for item in nodes])
+    assert np.all(weights >= 0) and np.sum(weights) > 0, ValueError('Density must be >= 0 and not all zero.')
+    weights = weights / np.sum(weights)
+    order = np.argsort(z)
+    z, weights = z[order], weights[order]
+    if np.searchsorted(np.cumsum(np.sort(weights)[::-1]), 0.99) + 1 < 4:
+        warnings.warn('depth_quadrature: fewer than 4 nodes carry 99% of the weight; the profile is not resolved.')
+    return z, weights
+
+
+class FieldProfile:
+    """
+    Analytic field (E or H) profile of a mode of a structure, stored as the forward and backward amplitudes
+    (a, b) and perpendicular wave vector q of every layer, in which the field is exactly
+    a * exp(iqz) + b * exp(-iqz). The field is evaluated lazily at any z, on any grid, including arbitrary depths
+    in the semi-infinite claddings, so the memory needed is O(layers) instead of O(z).
+
+    a, b and q have the layers along their first axis and can hold further axes (e.g. angles of incidence),
+    which are kept after the z axis in the evaluated fields.
+    """
+
+    def __init__(self, d_list, n_list, lam_vac, n_11, q, a, b, pol='TE', field='E'):
+        self.d_list = np.asarray(d_list)
+        self.n_list = np.asarray(n_list)
+        self.lam_vac = lam_vac
+        self.k_vac = 2 * np.pi / lam_vac
+        self.n_11 = n_11
+        self.k_11 = n_11 * self.k_vac
+        self.q = np.asarray(q)
+        self.a = np.asarray(a)
+        self.b = np.asarray(b)
+        self.pol = pol
+        self.field = field
+
+    def _waves(self, layer, z):
+        # Forward and backward waves at positions z within layer (or an array with the layer of every z)
+        z = np.asarray(z)
+        shape = z.shape + (1,) * (self.a.ndim - 1)
+        a, b, q = self.a[layer], self.b[layer], self.q[layer]
+        z = z.reshape(shape)
+        # Waves without amplitude (e.g. growing into the claddings of guided modes) are zero at any depth
+        with np.errstate(over='ignore', invalid='ignore'):
+            fwd = np.where(a == 0, 0, a * exp(1j * q * z))
+            bkwd = np.where(b == 0, 0, b * exp(-1j * q * z))
+        return fwd, bkwd
+
+    def layer_field(self, layer, z):
+        """
+        Evaluate the field at positions z within layer, measured from the lower boundary of the layer (negative
+        in the lower cladding). layer can also be an array with the layer of every z.
+        """
+        fwd, bkwd = self._waves(layer, z)
+        return fwd + bkwd
+
+    def __call__(self, z):
+        """ Evaluate the field at positions z measured from the bottom of the structure (see locate_z). """
+        layers, z_local = locate_z(self.d_list, np.asarray(z, dtype=float))
+        return self.layer_field(layers, z_local)
+
+    def field_squared(self, z):
+        """ Evaluate |field|^2 at positions z measured from the bottom of the structure. """
+        return abs(self(z)) ** 2
+
+    def layer_average(self, layer, z=None, dz=None):
+        """
+        Exact mean of |field|^2 over layer (an int or an array of layers), evaluated in closed form from the
+        amplitudes (see mean_squared) instead of sampling z. By default the mean is over the whole layer (which
+        must have a thickness), otherwise over the slab of thickness dz centred at z (local coordinates of
+        layer_field).
+        """
+        if z is None:
+            z, dz = layer_interval(self.d_list, layer)
+            assert np.all(dz > 0), ValueError('Layer must have a thickness to use this function.')
+        z = np.asarray(z, dtype=float)
+        shape = z.shape + (1,) * (self.a.ndim - 1)
+        return mean_squared(self.a[layer], self.b[layer], self.q[layer], z.reshape(shape),
+                            np.reshape(dz, np.shape(dz) + (1,) * (self.a.ndim - 1)))
+
+    def sample(self, z_step=1):
+        """
+        Sample the field over the structure on the grid of calc_field_structure.
+        Returns {'z', 'field', 'field_squared'}.
+        """
+        z = np.arange((z_step / 2.0), np.sum(self.d_list), z_step)
+        field = self(z)
+        return {'z': z, 'field': field, 'field_squared': abs(field) ** 2}
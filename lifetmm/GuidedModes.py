@@ -0,0 +1,261 @@
+import logging
+
+import numpy as np
+from numpy import pi, conj
+from scipy.constants import c
+
+from lifetmm.Fields import FieldProfile, mean_squared
+from lifetmm.HelperFunctions import grid_roots, bracket_roots, sinc
+
+log = logging.getLogger(__name__)
+
+
+class GuidedMode(FieldProfile):
+    """
+    A guided mode of a structure, as returned by calc_guided_modes(as_objects=True).
+
+    A FieldProfile (field amplitudes of E for TE and H for TM modes) that also holds the mode's group velocity
+    v_g. The amplitudes are normalised once on creation (Eq. B4 for TE and B8 for TM modes, the unnormalised
+    value is kept in norm), so the fields and emission rates are evaluated lazily at any z without going back
+    to the structure.
+    """
+
+    def __init__(self, n_11, v_g, pol, lam_vac, n_list, d_list, q, a, b):
+        assert pol in ['TE', 'TM'], ValueError('Polarisation must be either "TE" or "TM".')
+        super().__init__(d_list, n_list, lam_vac, n_11, q, a, b, pol, 'E' if pol == 'TE' else 'H')
+        self.v_g = v_g
+        self.norm = self._calc_norm(self.a, self.b)
+        self.a = self.a / np.sqrt(self.norm)
+        self.b = self.b / np.sqrt(self.norm)
+
+    @classmethod
+    def from_structure(cls, st, n_11, v_g=None, pol=None):
+        """
+        Create the guided mode with normalised parallel wave vector n_11 of the structure st for the polarisation
+        pol (the structure's polarisation by default). v_g is evaluated with calc_group_velocity if not given.
+        """
+        pol = st.pol if pol is None else pol
+        assert pol in ['TE', 'TM'], ValueError('Polarisation must be either "TE" or "TM".')
+        assert np.real(n_11) > max(st.n_list[0].real, st.n_list[-1].real), \
+            ValueError('The mode you are trying to solve for is not Guided')
+        field = 'E' if pol == 'TE' else 'H'
+        if v_g is None:
+            st_pol, st.pol = st.pol, pol
+            v_g = st.calc_group_velocity(np.array([n_11]))[0]
+            st.pol = st_pol
+        a, b = st.layer_field_amplitudes_batch(n_11, pol=pol, field=field)
+        q = np.array([st.calc_xi_batch(j, n_11) for j in range(st.num_layers)]) * st.k_vac
+        return cls(n_11, v_g, pol, st.lam_vac, st.n_list, st.d_list, q, a, b)
+
+    def __repr__(self):
+        return 'GuidedMode(pol={}, n_11={}, v_g={})'.format(self.pol, self.n_11, self.v_g)
+
+    def _calc_norm(self, a, b):
+        """
+        Normalisation of the mode from the unnormalised amplitudes (B4 for TE and B8 for TM modes).
+        Lossy modes (complex n_11) use the bilinear (unconjugated) form, which equals B4/B8 for lossless modes.
+        """
+        if np.iscomplexobj(self.n_11) and np.imag(self.n_11) != 0:
+            return self._calc_norm_bilinear(a, b)
+        k_11 = self.k_11
+        # Claddings: outgoing waves decaying away from the structure
+        chi_lower, chi_upper = np.imag(self.q[0]), np.imag(self.q[-1])
+        # Internal layers
+        q, d, a_j, b_j = self.q[1:-1], self.d_list[1:-1], a[1:-1], b[1:-1]
+        sinc_minus = sinc((q - conj(q)) * d / 2)
+        sinc_plus = sinc((q + conj(q)) * d / 2)
+        if self.pol == 'TE':
+            norm = abs(b[0]) ** 2 * (chi_lower ** 2 + k_11 ** 2) / (2 * chi_lower)
+            norm += abs(a[-1]) ** 2 * (chi_upper ** 2 + k_11 ** 2) / (2 * chi_upper)
+            w1 = (k_11 ** 2 + q * conj(q)) * sinc_minus
+            w2 = (k_11 ** 2 - q * conj(q)) * sinc_plus
+            norm += np.sum(d * (w1 * (abs(a_j) ** 2 + abs(b_j) ** 2) + w2 * (conj(a_j) * b_j + conj(b_j) * a_j)))
+            assert np.isclose(np.imag(norm), 0, atol=1e-9 * abs(norm)) and np.real(norm) > 0, \
+                ValueError('TE: Check Normalisation - should be real and > 0')
+        else:
+            norm = abs(b[0]) ** 2 / (2 * chi_lower) + abs(a[-1]) ** 2 / (2 * chi_upper)
+            w1 = (abs(a_j) ** 2 + abs(b_j) ** 2) * sinc_minus
+            w2 = (conj(a_j) * b_j + conj(b_j) * a_j) * sinc_plus
+            norm += np.sum(d * (w1 + w2))
+            assert np.isclose(np.imag(norm), 0, atol=1e-9 * abs(norm)), \
+                ValueError('TM: Check Normalisation - should be real')
+        return np.real(norm)
+
+    def _calc_norm_bilinear(self, a, b):
+        """
+        Normalisation of a lossy mode: B4 (TE) and B8 (TM) with the squared fields instead of |field|^2, which
+        is analytic in the complex n_11. Returns a complex norm.
+        """
+        k_11 = self.k_11
+        # Claddings: outgoing waves decaying away from the structure (complex decay constants)
+        chi_lower, chi_upper = -1j * self.q[0], -1j * self.q[-1]
+        # Internal layers
+        q, d, a_j, b_j = self.q[1:-1], self.d_list[1:-1], a[1:-1], b[1:-1]
+        sinc_2q = sinc(q * d)
+        if self.pol == 'TE':
+            norm = b[0] ** 2 * (chi_lower ** 2 + k_11 ** 2) / (2 * chi_lower)
+            norm += a[-1] ** 2 * (chi_upper ** 2 + k_11 ** 2) / (2 * chi_upper)
+            w1 = (k_11 ** 2 - q ** 2) * sinc_2q
+            w2 = k_11 ** 2 + q ** 2
+            norm += np.sum(d * (w1 * (a_j ** 2 + b_j ** 2) + w2 * 2 * a_j * b_j))
+        else:
+            norm = b[0] ** 2 / (2 * chi_lower) + a[-1] ** 2 / (2 * chi_upper)
+            norm += np.sum(d * ((a_j ** 2 + b_j ** 2) * sinc_2q + 2 * a_j * b_j))
+        assert np.isfinite(norm) and norm != 0, ValueError('{}: Check Normalisation - should be finite and != 0'
+                                                           .format(self.pol))
+        return norm
+
+    def electric_field(self, layer, z):
+        """
+        Evaluate the normalised electric field of the mode at positions z within layer (measured from the lower
+        boundary of the layer, negative in the lower cladding). layer can also be an array with the layer of
+        every z. Returns a dict of arrays holding 'TE' for TE modes, or the components perpendicular ('TM_s') and
+        parallel ('TM_p') to the interfaces for TM modes.
+        """
+        fwd, bkwd = self._waves(layer, z)
+        if self.pol == 'TE':
+            return {'TE': fwd + bkwd}
+        # E field components from the H field amplitudes
+        eps = self.n_list[layer].real ** 2
+        return {'TM_s': (1j * self.k_11 / eps) * (fwd + bkwd), 'TM_p': (1j * self.q[layer] / eps) * (-fwd + bkwd)}
+
+    def spe(self, layer, z, dz=None):
+        """
+        Evaluate the spontaneous emission rates into the mode at positions z within layer (see electric_field),
+        for each dipole orientation ('TE' or 'TM_s' and 'TM_p'), normalised to the vacuum emission rate of a
+        randomly orientated dipole. If the thicknesses dz are given, the rates are averaged exactly over the slabs
+        of thickness dz centred at z (see mean_squared). Lossy modes (complex n_11) are weighted with
+        Re(k_11 / v_g), which is accurate for weak losses.
+        """
+        scale = {'TE': 3 * pi * c / 4,
+                 'TM_s': (3 * c * self.lam_vac ** 4) / (2 ** 5 * pi ** 3),
+                 'TM_p': (3 * c * self.lam_vac ** 4) / (2 ** 6 * pi ** 3)}
+        if dz is None:
+            e2 = {key: abs(e) ** 2 for key, e in self.electric_field(layer, z).items()}
+        else:
+            a, b, q = self.a[layer], self.b[layer], self.q[layer]
+            if self.pol == 'TE':
+                e2 = {'TE': mean_squared(a, b, q, z, dz)}
+            else:
+                eps = self.n_list[layer].real ** 2
+                e2 = {'TM_s': abs(self.k_11 / eps) ** 2 * mean_squared(a, b, q, z, dz),
+                      'TM_p': abs(q / eps) ** 2 * mean_squared(a, -b, q, z, dz)}
+        return {key: value * np.real(self.k_11 / self.v_g) * scale[key] for key, value in e2.items()}
+
+
+def local_roots(f, guesses, widths, lower, upper, num=9, max_tries=12):
+    """
+    Find the roots of the vectorized function f closest to each of the guesses within [lower, upper],
+    with every root claimed by one guess only (the closest one).
+
+    f is evaluated on a small grid of num points over guess +- width for all the guesses in one call and the
+    chosen sign changes are polished together with bracket_roots. The windows of the guesses without a root
+    are doubled until a root is found or they cover [lower, upper]. Returns an array with nan where there is
+    no root.
+    """
+    guesses = np.array(guesses, dtype=float)
+    widths = np.array(widths, dtype=float)
+    results = np.full(guesses.shape, np.nan)
+    todo = np.arange(guesses.size)
+    for _ in range(max_tries):
+        if todo.size == 0:
+            break
+        a = np.maximum(lower, guesses[todo] - widths[todo])
+        b = np.minimum(upper, guesses[todo] + widths[todo])
+        x = np.linspace(a, b, num, axis=1)
+        with np.errstate(all='ignore'):
+            y = np.asarray(f(x.ravel()), dtype=float).reshape(x.shape)
+        # Sign change closest to each guess, skipping intervals with roots already claimed
+        brackets = []
+        for i, g in enumerate(guesses[todo]):
+            ind = [k for k in np.where(y[i, :-1] * y[i, 1:] <= 0)[0]
+                   if not np.any((results >= x[i, k]) & (results <= x[i, k + 1]))]
+            brackets.append(min(ind, key=lambda k: abs(x[i, k] + x[i, k + 1] - 2 * g)) if ind else None)
+        has_root = np.array([k is not None for k in brackets], dtype=bool)
+        i = np.where(has_root)[0]
+        k = np.array([brackets[j] for j in i], dtype=int)
+        roots = bracket_roots(f, x[i, k], x[i, k + 1])
+        # Two guesses can converge on the same root; the closest guess keeps it and the other tries again
+        for j, root in sorted(zip(todo[i], roots), key=lambda item: abs(item[1] - guesses[item[0]])):
+            if not np.any(np.isclose(root, results, rtol=0, atol=1e-9)):
+                results[j] = root
+        retry = np.isnan(results[todo])
+        widen = retry & ~has_root
+        widths[todo[widen]] *= 2
+        # Give up where the window already covers [lower, upper] without a root
+        todo = todo[retry & ~(widen & (a <= lower) & (b >= upper))]
+    return results
+
+
+def track_guided_modes(structures, calc_vg=True, verbose=False):
+    """
+    Follow the guided modes through a parameter sweep (e.g. a thickness scan).
+
+    structures is an iterable (a list or a generator) of TransferMatrix objects, one per sweep point and in
+    sweep order, with the polarization and field already set. The modes are found with calc_guided_modes
+    until the structure guides. Every later point only solves for the tracked modes locally around their
+    values extrapolated from the previous points, and searches for new modes (born at cutoff) below the
+    lowest tracked n_11, so a step costs a handful of vectorized s_11 evaluations.
+    Modes that can no longer be found have gone beyond cutoff and their curve ends.
+
+    Returns a list of dicts, one per mode ordered by the sweep point where it appeared, holding
+    'mode' (index of the mode), 'point' (indices of the sweep points it exists at), 'n_11' and 'v_g'
+    (from calc_group_velocity).
+    As in calc_guided_modes, modes within 0.01 of min(n) are discarded.
+    """
+    modes = []
+    alive = []
+    for point, st in enumerate(structures):
+        n = st.n_list.real
+        n_clad = max(n[0], n[-1])
+
+        if not alive:
+            n_11 = st.calc_guided_modes(verbose=False, normalised=True) if st.supports_guiding() else np.array([])
+            born = list(n_11)
+        else:
+            # Predict n_11 by linear extrapolation from the previous two points
+            history = [mode['n_11'][-2:] for mode in alive]
+            guesses = np.array([2 * x[-1] - x[0] for x in history])
+            widths = np.maximum(2 * abs(guesses - [x[-1] for x in history]), 1e-4)
+            # s_11 is not finite at n_clad itself, so the windows stop just above it
+            n_11 = local_roots(st.calc_s11_batch, guesses, widths, n_clad + 1e-9, max(n))
+            tracked = alive
+            lost = [mode for mode, x in zip(tracked, n_11) if np.isnan(x)]
+            for mode, x in zip(tracked, n_11):
+                if np.isnan(x) or x - min(n) < 0.01:
+                    mode['alive'] = False
+            alive = [mode for mode in tracked if mode['alive']]
+            n_11 = n_11[~np.isnan(n_11)]
+            n_11 = n_11[n_11 - min(n) >= 0.01]
+            # New modes appear at cutoff, below all the tracked modes
+            lower = max(n_clad + 1e-9, min(n) + 0.01)
+            upper = min(n_11) - 1e-6 if n_11.size else max(n)
+            born = list(grid_roots(st.calc_s11_batch, lower, upper, num=64, verbose=False)[::-1]) \
+                if upper > lower else []
+            n_11 = np.append(n_11, born)
+            # Roots in the range of the modes lost at this step are those modes (missed by the local search)
+            # rather than new ones
+            lost.sort(key=lambda mode: -mode['n_11'][-1])
+            for mode in lost[:len(born)]:
+                mode['alive'] = True
+                alive.append(mode)
+            born = born[len(lost):]
+            if verbose:
+                for mode in tracked:
+                    if not mode['alive']:
+                        logging.info('Mode {} reached cutoff at sweep point {}.'.format(mode['mode'], point))
+
+        for x in born:
+            alive.append({'mode': len(modes), 'point': [], 'n_11': [], 'v_g': [], 'alive': True})
+            modes.append(alive[-1])
+            if verbose and point > 0:
+                logging.info('Mode {} appeared at sweep point {}.'.format(alive[-1]['mode'], point))
+
+        v_g = st.calc_group_velocity(n_11) if calc_vg else np.full(n_11.shape, np.nan)
+        for mode, x, v in zip(alive, n_11, v_g):
+            mode['point'].append(point)
+            mode['n_11'].append(x)
+            mode['v_g'].append(v)
+
+    return [{'mode': mode['mode'], 'point': np.array(mode['point']), 'n_11': np.array(mode['n_11']),
+             'v_g': np.array(mode['v_g'])} for mode in modes]
@@ -1,4 +1,8 @@
 import logging
+import os
+import tempfile
+import warnings
+from functools import partial
 
 import numpy as np
 import scipy as sp
@@ -7,57 +11,357 @@ log = logging.getLogger(__name__)
 
 
 #####################################################################
-# Recursive root finding functions
-# http://stackoverflow.com/questions/13054758/python-finding-multiple-roots-of-nonlinear-equation
-def root_search(f, a, b, dx):
-    """
-    Find an interval f(x1) and f(x2=x1+dx) closest to a in the interval
-    [a,b] that contains a root. Starting at x1=a and x2=a+dx keep incrementing
-    x1 and x2 by dx until a sign change in f is observed or x1>=b is reached.
-    """
-    assert a <= b, ValueError('a must be less than b')
-    x1 = a
-    f1 = f(x1)
-    x2 = a + dx
-    f2 = f(x2)
-    while f1 * f2 > 0.0:
-        if x1 >= b:
-            return None, None
-        x1 = x2
-        f1 = f2
-        x2 = x2 + dx
-        f2 = f(x2)
-    return x1, x2
-
-
-def roots(f, a, b, eps=1e-5, verbose=True):
-    """
-    Find roots of f within the interval [a,b]. Interval is discretised
-    into num equal elements, dx, and a root is searched for within each dx.
-    """
-    import math
+# Root finding functions
+def grid_roots(f, a, b, num=1000, eps=1e-13, refine=16, max_nonfinite=0.1, verbose=True):
+    """
+    Find roots of f within the interval [a,b], where f is vectorized (evaluates a whole array of x at once).
+    f is evaluated on a grid of num points and every sign change is polished with brentq.
+    Grid points where |f| has a local minimum without a sign change may hide a close pair of roots
+    (e.g. the near degenerate modes of two weakly coupled waveguides), so those intervals are re-evaluated
+    on a finer grid (refine points) until they either show a sign change, no longer have a minimum or are
+    narrower than eps. Warns if more than a fraction max_nonfinite of the grid is not finite.
+    """
     from scipy.optimize import brentq
 
     if verbose:
         logging.info('The roots on the interval [{:f}, {:f}] are:'.format(a, b))
 
+    brackets = []
+    grids = [np.linspace(a, b, num)]
+    refining = False
+    while grids:
+        # Evaluate all the grids together in one vectorized call
+        with np.errstate(all='ignore'):
+            values = np.split(np.asarray(f(np.concatenate(grids)), dtype=float),
+                              np.cumsum([len(x) for x in grids])[:-1])
+        refined = []
+        for x, y in zip(grids, values):
+            finite = np.isfinite(y)
+            if np.mean(~finite) > max_nonfinite:
+                warnings.warn('grid_roots: f is not finite at {} of {} points in [{}, {}]; roots there are missed.'
+                              .format(np.sum(~finite), len(y), x[0], x[-1]))
+            x, y = x[finite], y[finite]
+            # Sign changes (or exact zeros) between neighbouring points
+            ind = np.where(y[:-1] * y[1:] <= 0)[0]
+            brackets += [(x[i], x[i + 1]) for i in ind]
+            # Local minima of |f| with no sign change either side
+            ay = abs(y)
+            ind = np.where((ay[1:-1] < ay[:-2]) & (ay[1:-1] < ay[2:]) &
+                           (y[:-2] * y[1:-1] > 0) & (y[1:-1] * y[2:] > 0))[0] + 1
+            if refining and ind.size:
+                # A refined grid spans a single minimum; further ones are round-off noise
+                ind = ind[[np.argmin(ay[ind])]]
+            refined += [np.linspace(x[i - 1], x[i + 1], refine) for i in ind if x[i + 1] - x[i - 1] > eps]
+        grids = refined
+        refining = True
+
     results = []
-    while 1:
-        x1, x2 = root_search(f, a, b, eps)
-        if x1 is not None:
-            a = x2
-            root = brentq(f, x1, x2)
-            if root != 0:
-                # Root is only as accurate as the width of the
-                # element as there could be multiple roots within each dx
-                root = round(root, -int(math.log(eps, 10)))
-                results.append(root)
-                if verbose:
-                    logging.info(root)
-        else:
+    for x1, x2 in sorted(set(brackets)):
+        root = brentq(lambda x: float(f(x)), x1, x2, xtol=eps)
+        if root != 0:
+            results.append(root)
             if verbose:
-                logging.info('Root finding done!')
-            return np.array(results)
+                logging.info(root)
+    if verbose:
+        logging.info('Root finding done!')
+    return np.unique(results)
+
+
+def bracket_roots(f, a, b, xtol=1e-12, max_iter=100):
+    """
+    Polish a whole array of root brackets [a, b] (f(a) * f(b) <= 0) at once with the Illinois
+    (modified regula falsi) method, where f is vectorized. Every iteration costs a single call of f
+    on all the brackets that have not converged yet.
+    """
+    a = np.array(a, dtype=float)
+    b = np.array(b, dtype=float)
+    with np.errstate(all='ignore'):
+        fa = np.asarray(f(a), dtype=float)
+        fb = np.asarray(f(b), dtype=float)
+    # Side of the bracket that was kept in the previous iteration (-1: a, 1: b)
+    side = np.zeros(a.shape)
+    x = np.where(fa == 0, a, b)
+    todo = (fa != 0) & (fb != 0) & (abs(b - a) > xtol)
+    for _ in range(max_iter):
+        if not np.any(todo):
+            break
+        i = np.where(todo)[0]
+        x[i] = (a[i] * fb[i] - b[i] * fa[i]) / (fb[i] - fa[i])
+        # Fall back to bisection where the secant step leaves the bracket
+        bad = ~((x[i] > np.minimum(a[i], b[i])) & (x[i] < np.maximum(a[i], b[i])))
+        x[i[bad]] = (a[i[bad]] + b[i[bad]]) / 2
+        with np.errstate(all='ignore'):
+            fx = np.asarray(f(x[i]), dtype=float)
+        left = fx * fa[i] > 0
+        # Root in [x, b]: replace a, halving f(b) if b was kept twice in a row (Illinois step)
+        j = i[left]
+        fb[j[side[j] == 1]] /= 2
+        a[j], fa[j], side[j] = x[j], fx[left], 1
+        j = i[~left]
+        fa[j[side[j] == -1]] /= 2
+        b[j], fb[j], side[j] = x[j], fx[~left], -1
+        todo[i] = (fx != 0) & (abs(b[i] - a[i]) > xtol * (1 + abs(x[i])))
+    return x
+
+
+def _contour_phase(f, z_lower, z_upper, num=64, max_step=np.pi / 4, max_points=2 ** 16):
+    """
+    Sample f anticlockwise around the rectangle with corners z_lower (bottom left) and z_upper
+    (top right), adding midpoints until log(f) (phase and magnitude) changes by less than max_step
+    between neighbouring points, so zeros close to the contour are resolved rather than aliased.
+    Returns the closed contour z and the continuous (unwrapped) log(f) on it.
+    """
+    corners = [z_lower, complex(z_upper.real, z_lower.imag), z_upper, complex(z_lower.real, z_upper.imag)]
+    # Same initial spacing on all sides (num points on the shorter side) so long thin rectangles are not aliased
+    sides = abs(np.diff(corners + corners[:1]))
+    nums = np.minimum(np.ceil(num * sides / min(sides)), 16 * num).astype(int)
+    z = np.concatenate([np.linspace(corners[i], corners[(i + 1) % 4], nums[i], endpoint=False) for i in range(4)])
+    z = np.append(z, z[0])
+    with np.errstate(all='ignore'):
+        values = np.asarray(f(z), dtype=complex)
+    while True:
+        if not np.all(np.isfinite(values)) or np.any(values == 0):
+            return z, None
+        d_log_f = np.log(values[1:] / values[:-1])
+        coarse = np.where(abs(d_log_f) > max_step)[0]
+        if coarse.size == 0:
+            break
+        if z.size + coarse.size > max_points:
+            return z, None
+        z_mid = (z[coarse] + z[coarse + 1]) / 2
+        with np.errstate(all='ignore'):
+            f_mid = np.asarray(f(z_mid), dtype=complex)
+        z = np.insert(z, coarse + 1, z_mid)
+        values = np.insert(values, coarse + 1, f_mid)
+    log_f = np.log(abs(values)) + 1j * np.concatenate(([np.angle(values[0])], np.angle(values[0]) + np.cumsum(d_log_f.imag)))
+    return z, log_f
+
+
+def contour_roots(f, z_lower, z_upper, max_zeros=4, tol=1e-12, verbose=True):
+    """
+    Find the complex roots of the analytic (vectorized) function f inside the rectangle with corners z_lower
+    and z_upper, counted with the argument principle and located with the Delves-Lyness method. Rectangles
+    with more than max_zeros zeros, or an unresolved boundary, are split in two.
+    """
+    z_lower = complex(z_lower)
+    z_upper = complex(z_upper)
+    results = []
+    stack = [(z_lower, z_upper, 0)]
+    while stack:
+        lower, upper, depth = stack.pop()
+        z, log_f = _contour_phase(f, lower, upper)
+        if log_f is not None:
+            num_zeros = int(round((log_f[-1] - log_f[0]).imag / (2 * np.pi)))
+            if num_zeros == 0:
+                continue
+            if num_zeros <= max_zeros:
+                # Power sums s_k = sum(z_i^k) of the zeros by midpoint integration of z^k dlog(f)
+                z_mid = (z[1:] + z[:-1]) / 2
+                d_log_f = np.diff(log_f)
+                power_sums = [np.sum(z_mid ** k * d_log_f) / (2j * np.pi) for k in range(1, num_zeros + 1)]
+                # Newton's identities to the polynomial coefficients (elementary symmetric polynomials)
+                coefficients = [1]
+                for k in range(1, num_zeros + 1):
+                    e_k = sum((-1) ** (i - 1) * coefficients[k - i] * power_sums[i - 1] for i in range(1, k + 1)) / k
+                    coefficients.append(e_k)
+                guesses = np.roots([(-1) ** k * e for k, e in enumerate(coefficients)])
+                roots_ = newton_polish(f, guesses, tol=tol)
+                inside = [root for root in roots_ if root is not None and
+                          lower.real <= root.real <= upper.real and lower.imag <= root.imag <= upper.imag]
+                if len(inside) == num_zeros and len(np.unique(np.round(inside, 8))) == num_zeros:
+                    results += inside
+                    if verbose:
+                        for root in inside:
+                            logging.info(root)
+                    continue
+        if depth > 40:
+            logging.warning('Could not resolve the zeros in [{}, {}].'.format(lower, upper))
+            continue
+        # Split along the longer side, slightly off centre so lossless roots on the real axis are not cut
+        if (upper - lower).real >= (upper - lower).imag:
+            split = lower.real + 0.5137 * (upper - lower).real
+            stack += [(lower, complex(split, upper.imag), depth + 1), (complex(split, lower.imag), upper, depth + 1)]
+        else:
+            split = lower.imag + 0.5137 * (upper - lower).imag
+            stack += [(lower, complex(upper.real, split), depth + 1), (complex(lower.real, split), upper, depth + 1)]
+    return np.array(results, dtype=complex)
+
+
+def newton_polish(f, z, tol=1e-12, max_iter=50):
+    """
+    Polish the guesses z of the roots of the analytic (vectorized) function f with Newton's method,
+    using a central difference for f'. Returns a list with None for guesses that did not converge.
+    """
+    z = np.array(z, dtype=complex)
+    converged = np.zeros(z.shape, dtype=bool)
+    for _ in range(max_iter):
+        h = 1e-7 * (1 + abs(z))
+        with np.errstate(all='ignore'):
+            values = np.asarray(f(np.concatenate((z, z + h, z - h))), dtype=complex).reshape(3, -1)
+            step = values[0] / ((values[1] - values[2]) / (2 * h))
+        step[converged | ~np.isfinite(step)] = 0
+        z -= step
+        converged |= abs(step) <= tol * (1 + abs(z))
+        if np.all(converged):
+            break
+    return [root if ok else None for root, ok in zip(z, converged)]
+
+
+#####################################################################
+# Numerical integration
+# Gauss-Kronrod (G7, K15) nodes and weights on [-1, 1]; the Gauss nodes are the odd Kronrod nodes.
+_XGK = np.array([0.991455371120812639206854697526329, 0.949107912342758524526189684047851,
+                 0.864864423359769072789712788640926, 0.741531185599394439863864773280788,
+                 0.586087235467691130294144845693013, 0.405845151377397166906606412076961,
+                 0.207784955007898467600689403773245, 0])
+_WGK = np.array([0.022935322010529224963732008058970, 0.063092092629978553290700663189204,
+                 0.104790010322250183839876322541518, 0.140653259715525918745189590510238,
+                 0.169004726639267902826583426598550, 0.190350578064785409913256402421014,
+                 0.204432940075298892414161999234649, 0.209482141084727828012999174891714])
+_WG = np.array([0, 0.129484966168869693270611432679082, 0, 0.279705391489276667901467771423780,
+                0, 0.381830050505118944950369775488975, 0, 0.417959183673469387755102040816327])
+_XK15 = np.concatenate((-_XGK, _XGK[-2::-1]))
+_WK15 = np.concatenate((_WGK, _WGK[-2::-1]))
+_WG7 = np.concatenate((_WG, _WG[-2::-1]))
+
+
+def _gauss_kronrod_block(f, x, half):
+    # Kronrod and Gauss sums of a block of intervals with nodes x
+    y = np.asarray(f(x.ravel()))
+    y = y.reshape(x.shape + y.shape[1:])
+    axes = (1,) * (y.ndim - 2)
+    kronrod = np.sum((half[:, None] * _WK15).reshape(x.shape + axes) * y, axis=1)
+    gauss = np.sum((half[:, None] * _WG7).reshape(x.shape + axes) * y, axis=1)
+    return kronrod, gauss
+
+
+def gauss_kronrod(f, a, b, tol=1e-6, breakpoints=(), max_intervals=1000, chunk=None, executor=None):
+    """
+    Adaptive Gauss-Kronrod (G7, K15) integral over [a, b], split at the breakpoints, of the vectorized (and
+    possibly vector valued) f, to the relative tolerance tol. See weighted_sum for chunk and executor.
+    Returns (integral, error, num_evaluations).
+    """
+    edges = np.unique(np.clip(np.concatenate(([a, b], np.ravel(breakpoints))), a, b))
+    lower, upper = edges[:-1], edges[1:]
+    num_intervals = len(lower)
+    # Running totals of the intervals within their share of the tolerance, which are not bisected again
+    integral_done = error_done = 0
+    num_evaluations = 0
+    while True:
+        # Evaluate the new intervals together, one block of intervals at a time
+        centre, half = (lower + upper) / 2, (upper - lower) / 2
+        x = centre[:, None] + half[:, None] * _XK15
+        num_evaluations += x.size
+        step = len(x) if chunk is None else max(int(chunk) // len(_XK15), 1)
+        starts = range(0, len(x), step)
+        blocks = (map if executor is None else executor.map)(partial(_gauss_kronrod_block, f),
+                                                             (x[start:start + step] for start in starts),
+                                                             (half[start:start + step] for start in starts))
+        integrals, gauss = (np.concatenate(sums) for sums in zip(*blocks))
+        errors = abs(integrals - gauss)
+
+        integral = integral_done + np.sum(integrals, axis=0)
+        total_error = error_done + np.sum(errors, axis=0)
+        scale = np.max(abs(integral))
+        if np.max(total_error) <= tol * scale:
+            break
+        # Bisect every interval with more than its share of the tolerance
+        interval_error = np.max(errors.reshape(len(errors), -1), axis=1)
+        split = interval_error > tol * scale * (upper - lower) / (b - a)
+        if not np.any(split):
+            split = interval_error == np.max(interval_error)
+        if num_intervals + np.sum(split) > max_intervals:
+            logging.warning('gauss_kronrod: maximum number of intervals reached; estimated relative error {:g}.'
+                            .format(np.max(total_error) / scale))
+            break
+        num_intervals += np.sum(split)
+        integral_done = integral_done + np.sum(integrals[~split], axis=0)
+        error_done = error_done + np.sum(errors[~split], axis=0)
+        mid = (lower[split] + upper[split]) / 2
+        lower, upper = np.concatenate((lower[split], mid)), np.concatenate((mid, upper[split]))
+    return integral, total_error, num_evaluations
+
+
+def romb_weights(num, dx=1.0):
+    """
+    Weights w of Romberg integration over num = 2**k+1 equally spaced samples with spacing dx, such that
+    np.dot(w, y) equals scipy.integrate.romb(y, dx). The Romberg extrapolation is linear in the samples, so the
+    weights are the extrapolated trapezoid weights of the nested grids.
+    """
+    k = int(round(np.log2(num - 1))) if num > 1 else -1
+    assert k >= 0 and num == 2 ** k + 1, ValueError('Number of samples must be 2**k+1.')
+    previous = []
+    for level in range(k + 1):
+        step = 2 ** (k - level)
+        trapezoid = np.zeros(num)
+        trapezoid[::step] = dx * step
+        trapezoid[[0, -1]] /= 2
+        row = [trapezoid]
+        for m, value in enumerate(previous, start=1):
+            row.append(row[-1] + (row[-1] - value) / (4 ** m - 1))
+        previous = row
+    return previous[-1]
+
+
+def _weighted_chunk(f, x, weights):
+    # Weighted sum of f over one chunk of samples
+    return np.tensordot(weights, np.asarray(f(x)), axes=1)
+
+
+def weighted_sum(f, x, weights, chunk=None, executor=None):
+    """
+    Sum of weights[..., i] * f(x[i]) over the samples i of the vectorized f, evaluated on at most chunk samples
+    at a time so the memory needed does not grow with the number of samples. With an executor (e.g. a
+    ProcessPoolExecutor) the chunks are evaluated in parallel, so f and the helpers sent to the workers are
+    picklable (module level), and reduced in order, so the result is identical to the serial one.
+    """
+    weights = np.asarray(weights)
+    chunk = len(x) if chunk is None else max(int(chunk), 1)
+    starts = range(0, len(x), chunk)
+    xs = (x[start:start + chunk] for start in starts)
+    ws = (weights[..., start:start + chunk] for start in starts)
+    parts = (map if executor is None else executor.map)(partial(_weighted_chunk, f), xs, ws)
+    total = 0
+    for part in parts:
+        total = total + part
+    return total
+
+
+def romberg(f, a, b, k_min=3, k_max=16, chunk=None, executor=None):
+    """
+    Generator of Romberg integrals of the vectorized f over [a, b] on nested grids of 2**k+1 points,
+    k = k_min...k_max, each level only evaluating the new midpoints. See weighted_sum for chunk and executor.
+    Yields (k, integral, error, num_evaluations), with the error estimated from the previous level.
+    """
+    assert 1 <= k_min <= k_max, ValueError('Need 1 <= k_min <= k_max.')
+
+    def extrapolate(trapezoid, previous):
+        # Next row of the Romberg table
+        row = [trapezoid]
+        for m, value in enumerate(previous, start=1):
+            row.append(row[-1] + (row[-1] - value) / (4 ** m - 1))
+        return row
+
+    # Initial grid; the trapezoid sums of the coarser (nested) grids are subsets of it
+    num_evaluations = 2 ** k_min + 1
+    weights = np.zeros((k_min + 1, num_evaluations))
+    for k in range(k_min + 1):
+        step = 2 ** (k_min - k)
+        weights[k, ::step] = (b - a) / 2 ** k
+        weights[k, [0, -1]] /= 2
+    trapezoids = weighted_sum(f, np.linspace(a, b, num_evaluations), weights, chunk, executor)
+    rows = [[]]
+    for trapezoid in trapezoids:
+        rows = [rows[-1], extrapolate(trapezoid, rows[-1])]
+    yield k_min, rows[1][-1], abs(rows[1][-1] - rows[0][-1]), num_evaluations
+
+    for k in range(k_min + 1, k_max + 1):
+        h = (b - a) / 2 ** k
+        x = a + h * (2 * np.arange(2 ** (k - 1)) + 1)
+        num_evaluations += len(x)
+        trapezoid = rows[1][0] / 2 + weighted_sum(f, x, np.full(len(x), h), chunk, executor)
+        rows = [rows[1], extrapolate(trapezoid, rows[1])]
+        yield k, rows[1][-1], abs(rows[1][-1] - rows[0][-1]), num_evaluations
 
 
 #####################################################################
@@ -75,6 +379,29 @@ def snell(n_1, n_2, th_1):
     return sp.arcsin(np.real_if_close(n_1 * np.sin(th_1) / n_2))
 
 
+def fresnel(nj, nk, qj, qk, pol, field='E'):
+    """
+    Return the reflection and transmission coefficients (r, t) at the interface from a
+    medium with refractive index nj to nk, where qj and qk are the normalised perpendicular
+    wave-vectors. Works on scalars and (broadcastable) arrays of q alike.
+    """
+    if pol in ['p', 'TM']:
+        # Note r_p is defined where the E field flips direction by pi on reflection.
+        # See Fig 2.2 in Principles of Nano-Optics, L. Novotny, B. Hecht.
+        r = (nk ** 2 * qj - nj ** 2 * qk) / (nk ** 2 * qj + nj ** 2 * qk)
+        t = (2 * nj * nk * qj) / (qj * nk ** 2 + qk * nj ** 2)
+    elif pol in ['s', 'TE']:
+        r = (qj - qk) / (qj + qk)
+        t = (2 * qj) / (qj + qk)
+    else:
+        raise ValueError('A polarisation for the field must be set.')
+    if field == 'H':
+        # Convert transmission coefficient for E field to that of the H field.
+        # The reflection coefficient is the same as the medium does not change.
+        t = t * nk / nj
+    return r, t
+
+
 def lambda2omega(lambda_):
     """Convert wavelength to omega."""
     from scipy.constants import lambda2nu
@@ -97,9 +424,90 @@ def det(matrix):
     return matrix[0, 0] * matrix[1, 1] - matrix[1, 0] * matrix[0, 1]
 
 
+def t_to_s(m):
+    """
+    Convert stacked 2x2 transfer matrices (..., 2, 2), relating the fields on the left to those
+    on the right, to scattering matrices [[r, t_minus], [t, r_minus]] relating outgoing to incoming waves.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inv = 1 / m[..., 0, 0]
+        s = np.empty_like(m)
+        s[..., 0, 0] = m[..., 1, 0] * inv
+        s[..., 0, 1] = (m[..., 0, 0] * m[..., 1, 1] - m[..., 1, 0] * m[..., 0, 1]) * inv
+        s[..., 1, 0] = inv
+        s[..., 1, 1] = -m[..., 0, 1] * inv
+    return s
+
+
+def redheffer(a, b):
+    """
+    Redheffer star product of stacked 2x2 scattering matrices a (left) and b (right), i.e. the
+    scattering matrix of the two systems in series. Stable as only bounded quantities are combined.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d = 1 / (1 - a[..., 1, 1] * b[..., 0, 0])
+        c = np.empty(np.broadcast(a, b).shape, dtype=complex)
+        c[..., 0, 0] = a[..., 0, 0] + a[..., 0, 1] * b[..., 0, 0] * a[..., 1, 0] * d
+        c[..., 0, 1] = a[..., 0, 1] * b[..., 0, 1] * d
+        c[..., 1, 0] = b[..., 1, 0] * a[..., 1, 0] * d
+        c[..., 1, 1] = b[..., 1, 1] + b[..., 1, 0] * a[..., 1, 1] * b[..., 0, 1] * d
+    return c
+
+
+def chebyshev_power(m, num):
+    """
+    Raise stacked unimodular (det=1) 2x2 matrices m (..., 2, 2) to the integer power num in closed form
+    with the Chebyshev (Abeles) identity: m^N = U_{N-1}(a) m - U_{N-2}(a) I, a = tr(m) / 2.
+    The cost is independent of num.
+    """
+    a = (m[..., 0, 0] + m[..., 1, 1]) / 2
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        th = np.arccos(a.astype(complex))
+        sin_th = np.sin(th)
+        # U_{N-1}(cos(th)) = sin(N th) / sin(th), with the limit N a^(N-1) at the band edges a = +-1
+        edge = abs(sin_th) < 1e-8
+        u1 = np.where(edge, num * a ** (num - 1), np.sin(num * th) / sin_th)
+        u2 = np.where(edge, (num - 1) * a ** (num - 2), np.sin((num - 1) * th) / sin_th)
+    return u1[..., None, None] * m - u2[..., None, None] * np.identity(2)
+
+
+def redheffer_power(s, num):
+    """
+    Raise stacked 2x2 scattering matrices s (..., 2, 2) to the integer power num under the Redheffer
+    star product (num identical systems in series) by repeated squaring, i.e. O(log(num)) products.
+    """
+    result = np.broadcast_to(np.array([[0, 1], [1, 0]], dtype=complex), s.shape)
+    while num > 0:
+        if num & 1:
+            result = redheffer(result, s)
+        s = redheffer(s, s)
+        num >>= 1
+    return result
+
+
 def sinc(x):
-    """Un-normalised sinc function: sinc(x) = sin(x) / x. Note numpy's function is normalised."""
-    if x == 0:
-        return 1
-    else:
-        return sp.sin(x) / x
+    """
+    Un-normalised sinc function: sinc(x) = sin(x) / x, for scalars and (complex) arrays alike.
+    Note numpy's function is normalised.
+    """
+    return np.sinc(np.asarray(x) / np.pi)
+
+
+#####################################################################
+# File functions
+def atomic_write(filename, write):
+    """
+    Write a file with write(f), where f is the file opened in binary mode. The data is written to a temporary
+    file in the same directory which is then renamed, so that filename is either complete or unchanged even if
+    the process dies while writing.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, filename)
+    except BaseException:
+        os.remove(tmp)
+        raise
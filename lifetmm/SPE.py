@@ -1,36 +1,44 @@
 import logging
-import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import partial
 
 import matplotlib.pyplot as plt
 import numpy as np
-import scipy.integrate as integrate
-from numpy import pi, sin, sum, exp, conj
-from scipy.constants import c
-from tqdm import *
+from numpy import pi, sin, exp
 
-from lifetmm.HelperFunctions import sinc
+from lifetmm.Cache import cached
+from lifetmm.Fields import locate_z, layer_interval, mean_squared, depth_quadrature
+from lifetmm.HelperFunctions import gauss_kronrod, romberg, romb_weights, weighted_sum
 from lifetmm.TransferMatrix import TransferMatrix
 
 log = logging.getLogger(__name__)
 
 
 class SPE(TransferMatrix):
-    def calc_spe_layer_leaky(self, layer, emission='Lower', th_pow=8, z_step=1):
+    # Maximum number of (angle, z) points of the leaky mode integrand held in memory at once
+    leaky_chunk_size = 2 ** 20
+    # Maximum number of angles per chunk of the leaky mode integrand (also the unit of work with workers > 1)
+    leaky_chunk_angles = 64
+
+    def calc_spe_layer_leaky(self, layer, emission='Lower', th_pow=8, z_step=1, quadrature='romb', tol=1e-6,
+                             workers=None):
         """
         Evaluate the spontaneous emission rates for dipoles in a layer radiating into 'Lower' or 'Upper' modes.
         Rates are normalised w.r.t. free space emission or a randomly orientated dipole.
+
+        The angle integral uses Romberg integration over 2**th_pow+1 angles (quadrature='romb'), adaptive
+        Gauss-Kronrod integration to the relative tolerance tol (quadrature='gauss') or Romberg integration
+        progressively refined to tol, up to th_pow (quadrature='progressive'), see _calc_spe_leaky.
+        The estimated absolute errors of the rates are returned in 'error'.
+        With workers > 1 the chunks of angles are evaluated on a pool of that many processes; the results are
+        identical to the serial ones.
         """
         # Option checks
         assert emission in ['Lower', 'Upper'], ValueError('Emission option must be either "Upper" or "Lower".')
         assert isinstance(th_pow, int), ValueError('th_pow must be an integer.')
         assert self.d_list[layer] > 0, ValueError('Layer must have a thickness to use this function.')
 
-        # Flip the structure and solve using lower leaky equations for upper leaky modes.
-        # Results are flipped back at the end of this function to give the correct orientation again.
-        if emission == 'Upper':
-            self.flip()
-            layer = self.num_layers - layer - 1
-
         # z positions to evaluate E at
         z = np.arange((z_step / 2.0), self.d_list[layer], z_step)
         if layer == 0:
@@ -38,96 +46,146 @@ class SPE(TransferMatrix):
             # Therefore must propagate waves backwards in the first cladding.
             z = -z[::-1]
 
-        # Angles of emission to simulate over.
-        # Note: don't include pi/2 as then transmission and reflection do not make sense (light not incident).
-        # res for linspace must have this form for the simpsons integration later. Can change the power.
-        res = 2 ** th_pow + 1
-        th_in, dth = np.linspace(0, pi / 2, num=res, endpoint=False, retstep=True)
-
-        # Structure to hold field E(z) components of each mode for each dipole orientation for a given theta
-        E = np.zeros(len(z), dtype=[('TE', 'complex128'),
-                                    ('TM_p', 'complex128'),
-                                    ('TM_s', 'complex128')])
-
-        # Arrays to store the square of the E fields for all thetas and z
-        E2_z_th = np.zeros((len(th_in), len(z)), dtype=[('TE_full', 'float64'),
-                                                        ('TM_p_full', 'float64'),
-                                                        ('TM_s_full', 'float64'),
-                                                        ('TE_partial', 'float64'),
-                                                        ('TM_p_partial', 'float64'),
-                                                        ('TM_s_partial', 'float64')])
-
-        # Structure to hold field SPE(z) components of each mode for each dipole orientation for a theta
-        spe = np.zeros(len(z), dtype=[('total', 'float64'),
-                                      ('TE', 'float64'),
-                                      ('TM_p', 'float64'),
-                                      ('TM_s', 'float64'),
-                                      ('TE_full', 'float64'),
-                                      ('TM_p_full', 'float64'),
-                                      ('TM_s_full', 'float64'),
-                                      ('TE_partial', 'float64'),
-                                      ('TM_p_partial', 'float64'),
-                                      ('TM_s_partial', 'float64')])
-
-        # Params for tqdm progress bar
-        kwargs = {'total': res, 'unit': ' theta', 'unit_scale': True}
-        # Evaluate all E field components for TE and TM modes looping over the emission angles.
-        for i, theta in tqdm(enumerate(th_in), **kwargs):
-            # Set the angle to be evaluated
-            self.set_incident_angle(theta)
-
-            # Wave vector components in layer (q, k_11 are angle dependent)
-            k, q, k_11 = self.calc_wave_vector_components(layer)
-
-            # Check that the mode exists
-            assert k_11 ** 2 <= self.calc_k(0) ** 2, ValueError('k_11 can not be larger than k0!')
+        with process_pool(workers) as executor:
+            spe, error = self._calc_spe_leaky(z, np.full(len(z), layer), emission, th_pow, quadrature, tol, executor)
+        return {'z': z, 'spe': spe, 'error': error}
+
+    def _calc_spe_leaky(self, z, layers, emission, th_pow, quadrature='romb', tol=1e-6, executor=None, dz=None):
+        """
+        Evaluate the leaky mode spontaneous emission rates at positions z (local to the layers given by the
+        array layers, as _locate_z), or averaged over the slabs of thicknesses dz centred at z, with the
+        quadrature options of calc_spe_layer_leaky. Returns the rates and their estimated errors (spe, error).
+        """
+        assert quadrature in ['romb', 'gauss', 'progressive'], \
+            ValueError('Quadrature option must be either "romb", "gauss" or "progressive".')
+        n_in = self.n_list[0] if emission == 'Lower' else self.n_list[-1]
+        chunk = max(min(self.leaky_chunk_size // max(len(z), 1), self.leaky_chunk_angles), 1)
+        integrand = partial(self._leaky_integrand, z=z, layers=layers, emission=emission, dz=dz)
+
+        if quadrature == 'romb':
+            # Angles of emission to simulate over.
+            # Note: don't include pi/2 as then transmission and reflection do not make sense (light not incident).
+            # res for linspace must have this form for the simpsons integration later. Can change the power.
+            res = 2 ** th_pow + 1
+            th_in, dth = np.linspace(0, pi / 2, num=res, endpoint=False, retstep=True)
+            # Romberg weights, and those of the next coarser (nested) grid for the error estimate
+            weights = np.zeros((2, res))
+            weights[0] = romb_weights(res, dth)
+            if th_pow > 0:
+                weights[1, ::2] = romb_weights(2 ** (th_pow - 1) + 1, 2 * dth)
+            # Evaluate spontaneous emission rate for each z by accumulating over chunks of thetas
+            integral, coarse = weighted_sum(integrand, th_in, weights, chunk, executor)
+            error = abs(integral - coarse)
+        elif quadrature == 'gauss':
+            # Split the angle range at the critical angles, where the integrand has kinks
+            n = self.n_list.real
+            critical = np.arcsin(n[n < n_in.real] / n_in.real)
+            integral, error, num_angles = gauss_kronrod(integrand, 0, pi / 2, tol=tol, breakpoints=critical,
+                                                        chunk=chunk, executor=executor)
+            logging.info('Leaky modes ({}) integrated with {} angles.'.format(emission, num_angles))
+        else:
+            for k, integral, error, num_angles in romberg(integrand, 0, pi / 2, k_min=min(3, th_pow), k_max=th_pow,
+                                                          chunk=chunk, executor=executor):
+                if np.max(error) <= tol * np.max(abs(integral)):
+                    break
+            logging.info('Leaky modes ({}) integrated with {} angles (th_pow={}), estimated relative error {:g}.'
+                         .format(emission, num_angles, k, np.max(error) / np.max(abs(integral))))
+        return self._leaky_rates(integral, layers, n_in), self._leaky_rates(error, layers, n_in)
+
+    # Order of the leaky integrand components (see _leaky_integrand)
+    _leaky_keys = ['TE_full', 'TM_p_full', 'TM_s_full', 'TE_partial', 'TM_p_partial', 'TM_s_partial']
+
+    def _leaky_integrand(self, th_in, z, layers, emission, dz=None):
+        """
+        The (sin(theta) weighted) squared leaky mode E fields of each component in _leaky_keys for all the
+        emission angles th_in and positions z in layers (see _calc_spe_leaky), with shape (len(th_in), 6, len(z)).
+        The field amplitudes of every layer come from a single set of partial matrices per angle, and all
+        emission angles and z positions of all layers are evaluated at once.
+        If the thicknesses dz (one per z) are given, the squared fields are instead averaged exactly over the slabs
+        of thickness dz centred at z (see mean_squared).
+        """
+        # Outgoing (emission) modes are incident from the lower or upper cladding in the time reversed picture.
+        # Upper leaky modes are solved with the upper incidence amplitudes so the structure is never flipped.
+        n_in = self.n_list[0] if emission == 'Lower' else self.n_list[-1]
+        # Partially leaky modes are evanescent in the opposite cladding
+        j_out = self.num_layers - 1 if emission == 'Lower' else 0
+
+        # Parallel normalised wave vector (see set_incident_angle)
+        n_11 = n_in * sin(th_in)
+        # No light is coupled into the structure at grazing incidence (theta = pi/2, where t = 0)
+        grazing = n_11 == n_in
+        if np.any(grazing):
+            result = np.zeros((len(th_in), len(self._leaky_keys), len(z)))
+            result[~grazing] = self._leaky_integrand(th_in[~grazing], z, layers, emission, dz)
+            return result
+
+        # Wave vector components in the layer of each z (q, k_11 are angle dependent)
+        xi = np.array([self.calc_xi_batch(j, n_11) for j in range(self.num_layers)])
+        q = xi[layers].T * self.k_vac
+        k_11 = (n_11 * self.k_vac)[:, None]
+
+        # E (TE) and H (TM) field coefficients in terms of incoming amplitude
+        E_plus, E_minus = self.layer_field_amplitudes_batch(n_11, pol='TE', field='E', incidence=emission)
+        H_plus, H_minus = self.layer_field_amplitudes_batch(n_11, pol='TM', field='H', incidence=emission)
+        E_plus, E_minus, H_plus, H_minus = (x[layers].T for x in (E_plus, E_minus, H_plus, H_minus))
+
+        E2 = {key: np.empty((len(th_in), len(z))) for key in ['TE', 'TM_s', 'TM_p']}
+        # Slabs with a thickness are averaged exactly, the other positions use the field at z
+        slab = np.zeros(len(z), dtype=bool) if dz is None else np.asarray(dz) > 0
+        if not np.all(slab):
+            i = slice(None) if not np.any(slab) else ~slab
+            phase_plus = exp(1j * q[:, i] * z[i])
+            phase_minus = exp(-1j * q[:, i] * z[i])
 
             # !* TE leaky modes *!
-            self.set_polarization('TE')
-            # Calculate E field within layer
-            self.set_field('E')
-            # E field coefficients in terms of incoming amplitude
-            E_plus, E_minus = self.layer_field_amplitudes(layer)
-            E['TE'] = E_plus * exp(1j * q * z) + E_minus * exp(-1j * q * z)
             # Orthonormality condition (3): Normalise outgoing TE wave to medium refractive index [n=sqrt(eps)]
-            E['TE'] /= self.n_list[0]
+            E2['TE'][:, i] = abs((E_plus[:, i] * phase_plus + E_minus[:, i] * phase_minus) / n_in) ** 2
 
             # !* TM leaky modes *!
-            self.set_polarization('TM')
-            # Calculate H field within layer
-            self.set_field('H')
-            # H field coefficients in terms of incoming amplitude
-            H_plus, H_minus = self.layer_field_amplitudes(layer)
-            # Calculate the electric field component perpendicular (s) to the interface
-            E['TM_s'] = k_11*(H_plus * exp(1j * q * z) + H_minus * exp(-1j * q * z))
-            # Calculate the electric field component parallel (p) to the interface
-            E['TM_p'] = q*(H_plus * exp(1j * q * z) - H_minus * exp(-1j * q * z))
-
-            # Take the squares of all E field components and add sin(theta) weighting
-            for key in list(E.dtype.names):
-                E[key] = abs(E[key]) ** 2 * sin(theta)
-
-            # Wave vector components in upper cladding
-            q_clad = self.calc_q(self.num_layers - 1)
-            # Split solutions into partial and fully leaky modes
-            if np.iscomplex(q_clad):
-                E2_z_th['TE_partial'][i, :] += E['TE'].real
-                E2_z_th['TM_p_partial'][i, :] += E['TM_p'].real
-                E2_z_th['TM_s_partial'][i, :] += E['TM_s'].real
-            else:
-                E2_z_th['TE_full'][i, :] += E['TE'].real
-                E2_z_th['TM_p_full'][i, :] += E['TM_p'].real
-                E2_z_th['TM_s_full'][i, :] += E['TM_s'].real
-
-        for key in list(E2_z_th.dtype.names):
-            # Evaluate spontaneous emission rate for each z (columns) over all thetas (rows)
-            spe[key] = integrate.romb(E2_z_th[key], dx=dth, axis=0)
+            h_plus = H_plus[:, i] * phase_plus
+            h_minus = H_minus[:, i] * phase_minus
+            # Electric field components perpendicular (s) and parallel (p) to the interface
+            E2['TM_s'][:, i] = abs(k_11 * (h_plus + h_minus)) ** 2
+            E2['TM_p'][:, i] = abs(q[:, i] * (h_plus - h_minus)) ** 2
+        if np.any(slab):
+            # Exact averages over the slabs (q is constant within each layer)
+            q_s, z_s, dz_s = q[:, slab], z[slab], np.asarray(dz)[slab]
+            E2['TE'][:, slab] = mean_squared(E_plus[:, slab], E_minus[:, slab], q_s, z_s, dz_s) / abs(n_in) ** 2
+            E2['TM_s'][:, slab] = abs(k_11) ** 2 * mean_squared(H_plus[:, slab], H_minus[:, slab], q_s, z_s, dz_s)
+            E2['TM_p'][:, slab] = abs(q_s) ** 2 * mean_squared(H_plus[:, slab], -H_minus[:, slab], q_s, z_s, dz_s)
+
+        # Partially leaky modes are evanescent in the opposite cladding (complex q)
+        partial = np.iscomplex(xi[j_out])[:, None]
+        result = np.empty((len(th_in), len(self._leaky_keys), len(z)))
+        for i, key in enumerate(self._leaky_keys):
+            mode, kind = key.rsplit('_', 1)
+            # Add sin(theta) weighting
+            result[:, i] = np.where(partial == (kind == 'partial'), E2[mode] * sin(th_in)[:, None], 0)
+        return result
+
+    def _leaky_rates(self, integral, layers, n_in):
+        """
+        Normalised emission rates (structured array) from the angle integrals of the leaky integrand components.
+        """
+        # Structure to hold field SPE(z) components of each mode for each dipole orientation
+        spe = np.zeros(integral.shape[-1], dtype=[('total', 'float64'),
+                                                  ('TE', 'float64'),
+                                                  ('TM_p', 'float64'),
+                                                  ('TM_s', 'float64'),
+                                                  ('TE_full', 'float64'),
+                                                  ('TM_p_full', 'float64'),
+                                                  ('TM_s_full', 'float64'),
+                                                  ('TE_partial', 'float64'),
+                                                  ('TM_p_partial', 'float64'),
+                                                  ('TM_s_partial', 'float64')])
+        for i, key in enumerate(self._leaky_keys):
             # Outgoing mode refractive index weighting (between summation over j=0,M+1 and integral -> eps_j** 3/2)
-            spe[key] *= self.n_list[0].real ** 3
+            spe[key] = integral[i] * n_in.real ** 3
 
         # Normalise emission rates to vacuum emission rate of a randomly orientated dipole
-        nj = self.n_list[layer].real
-        for key in list(E2_z_th.dtype.names):
+        nj = self.n_list[layers].real
+        k = nj * self.k_vac
+        for key in self._leaky_keys:
             if 'TE' in key:
                 spe[key] *= 3/8
             elif 'TM_p' in key:
@@ -140,32 +198,75 @@ class SPE(TransferMatrix):
         spe['TM_p'] = spe['TM_p_full'] + spe['TM_p_partial']
         spe['TM_s'] = spe['TM_s_full'] + spe['TM_s_partial']
         spe['total'] = spe['TE'] + spe['TM_p'] + spe['TM_s']
+        return spe
 
-        # Flip structure and results back to original orientation
-        if emission == 'Upper':
-            self.flip()
-            for key in list(spe.dtype.names):
-                spe[key] = spe[key][::-1]
-
-        return {'z': z, 'spe': spe}
-
-    def calc_spe_structure_leaky(self, th_pow=8, z_step=1):
+    def calc_spe_structure_leaky(self, th_pow=8, z_step=1, quadrature='romb', tol=1e-6, workers=None):
         """
         Evaluate the spontaneous emission rate vs z of the structure for each dipole orientation.
         Rates are normalised w.r.t. free space emission or a randomly orientated dipole.
+        See calc_spe_layer_leaky for the quadrature and workers options; the estimated errors are returned in
+        'error'.
         """
         assert self.mode_type() == 'Leaky', ValueError('The mode you are trying to solve for is not Leaky')
+        z_pos, z_mat, z_local = self._structure_z(z_step)
+
+        # Calculate emission rates for leaky modes in all layers at once
+        logging.info('Evaluating lower and upper leaky modes...')
+        with process_pool(workers) as executor:
+            spe_lower, error_lower = self._calc_spe_leaky(z_local, z_mat, 'Lower', th_pow, quadrature, tol, executor)
+            spe_upper, error_upper = self._calc_spe_leaky(z_local, z_mat, 'Upper', th_pow, quadrature, tol, executor)
 
+        # The errors add up in the same way as the rates (all the weights are positive)
+        spe = self._combine_spe_leaky(spe_lower, spe_upper)
+        error = self._combine_spe_leaky(error_lower, error_upper)
+        return {'z': z_pos, 'spe': spe, 'error': error}
+
+    def iter_spe_structure_leaky(self, z_step=1, th_pow_min=3, th_pow_max=14, workers=None):
+        """
+        Generator of progressively refined leaky mode emission rates of the structure (see
+        calc_spe_structure_leaky), e.g. for interactive previews. Every level th_pow = th_pow_min...th_pow_max
+        doubles the number of angles on nested grids over [0, pi/2], evaluating only the new midpoints, and
+        yields {'th_pow', 'z', 'spe', 'error'} with the Romberg error estimate between levels.
+        """
+        assert self.mode_type() == 'Leaky', ValueError('The mode you are trying to solve for is not Leaky')
+        z_pos, z_mat, z_local = self._structure_z(z_step)
+        chunk = max(min(self.leaky_chunk_size // max(len(z_local), 1), self.leaky_chunk_angles), 1)
+        n_lower, n_upper = self.n_list[0], self.n_list[-1]
+        with process_pool(workers) as executor:
+            levels = [romberg(partial(self._leaky_integrand, z=z_local, layers=z_mat, emission=emission),
+                              0, pi / 2, th_pow_min, th_pow_max, chunk=chunk, executor=executor)
+                      for emission in ['Lower', 'Upper']]
+            for (th_pow, lower, error_lower, _), (_, upper, error_upper, _) in zip(*levels):
+                spe = self._combine_spe_leaky(self._leaky_rates(lower, z_mat, n_lower),
+                                              self._leaky_rates(upper, z_mat, n_upper))
+                error = self._combine_spe_leaky(self._leaky_rates(error_lower, z_mat, n_lower),
+                                                self._leaky_rates(error_upper, z_mat, n_upper))
+                yield {'th_pow': th_pow, 'z': z_pos, 'spe': spe, 'error': error}
+
+    def _structure_z(self, z_step):
+        """
+        Return the z positions over the entire structure, the layer of each and the position relative to the
+        lower boundary of that layer (negative in the lower cladding).
+        """
         # z positions to evaluate E field at over entire structure
         z_pos = np.arange((z_step / 2.0), self.d_cumulative[-1], z_step)
+        z_mat, z_local = self._locate_z(z_pos)
+        return z_pos, z_mat, z_local
 
-        # get z_mat - specifies what layer the corresponding point in z_pos is in
-        comp1 = np.kron(np.ones((self.num_layers, 1)), z_pos)
-        comp2 = np.transpose(np.kron(np.ones((len(z_pos), 1)), self.d_cumulative))
-        z_mat = sum(comp1 > comp2, 0)
+    def _locate_z(self, z_pos):
+        """
+        Return the layer of each of the positions z_pos (measured from the bottom of the structure, as in
+        calc_spe_structure) and the position relative to the lower boundary of that layer (see locate_z).
+        """
+        return locate_z(self.d_list, z_pos)
 
+    @staticmethod
+    def _combine_spe_leaky(lower, upper):
+        """
+        Combine the lower and upper leaky mode emission rates (see _leaky_rates) into the structure totals.
+        """
         # Structure to hold field spontaneous emission rate components over z
-        spe = np.zeros(len(z_pos), dtype=[('total', 'float64'),
+        spe = np.zeros(len(lower), dtype=[('total', 'float64'),
                                           ('parallel', 'float64'),
                                           ('perpendicular', 'float64'),
                                           ('avg', 'float64'),
@@ -186,39 +287,11 @@ class SPE(TransferMatrix):
                                           ('TE_upper', 'float64'),
                                           ('TM_p_upper', 'float64'),
                                           ('TM_s_upper', 'float64')])
-
-        # Calculate emission rates for leaky modes in each layer
-        logging.info('Evaluating lower and upper leaky modes for each layer:')
-        for layer in range(min(z_mat), max(z_mat) + 1):
-            # logging.info simulation information to command line
-            if layer == 0:
-                logging.info('\tLayer -> lower cladding...')
-            elif layer == self.num_layers - 1:
-                logging.info('\tLayer -> upper cladding...')
-            else:
-                logging.info('\tLayer -> internal {0:d} / {1:d}...'.format(layer, self.num_layers - 2))
-            time.sleep(0.2)  # Fixes progress bar occurring before text
-
-            # Find indices corresponding to the layer we are evaluating
-            ind = np.where(z_mat == layer)
-
-            # Calculate lower leaky modes
-            spe_layer = self.calc_spe_layer_leaky(layer, emission='Lower', th_pow=th_pow)['spe']
-            spe['TE_lower'][ind] += spe_layer['TE']
-            spe['TM_p_lower'][ind] += spe_layer['TM_p']
-            spe['TM_s_lower'][ind] += spe_layer['TM_s']
-            spe['TE_lower_full'][ind] += spe_layer['TE_full']
-            spe['TM_s_lower_full'][ind] += spe_layer['TM_s_full']
-            spe['TM_p_lower_full'][ind] += spe_layer['TM_p_full']
-            spe['TE_lower_partial'][ind] += spe_layer['TE_partial']
-            spe['TM_s_lower_partial'][ind] += spe_layer['TM_s_partial']
-            spe['TM_p_lower_partial'][ind] += spe_layer['TM_p_partial']
-
-            # Calculate upper leaky modes (always leaky as n[0] > n[-1])
-            spe_layer = self.calc_spe_layer_leaky(layer, emission='Upper', th_pow=th_pow)['spe']
-            spe['TE_upper'][ind] += spe_layer['TE']
-            spe['TM_p_upper'][ind] += spe_layer['TM_p']
-            spe['TM_s_upper'][ind] += spe_layer['TM_s']
+        for key in ['TE', 'TM_p', 'TM_s']:
+            spe[key + '_lower'] = lower[key]
+            spe[key + '_lower_full'] = lower[key + '_full']
+            spe[key + '_lower_partial'] = lower[key + '_partial']
+            spe[key + '_upper'] = upper[key]
 
         # Totals
         spe['TE'] = spe['TE_lower'] + spe['TE_upper']
@@ -232,30 +305,32 @@ class SPE(TransferMatrix):
 
         # Average for a randomly orientated dipole
         spe['avg'] = (2 / 3) * spe['parallel'] + (1 / 3) * spe['perpendicular']
+        return spe
 
-        return {'z': z_pos, 'spe': spe}
+    def calc_guided_mode_objects(self):
+        """
+        Return the guided modes of both polarisations as GuidedMode objects (see calc_guided_modes), TE modes
+        first. The structure is left with the TM polarisation and H field set.
+        """
+        logging.info('Evaluating guided modes (k_11/k) and group velocity for each polarisation:')
+        modes = []
+        for pol, field in [('TE', 'E'), ('TM', 'H')]:
+            logging.info('Finding {} modes...'.format(pol))
+            self.set_polarization(pol)
+            self.set_field(field)
+            modes += self.calc_guided_modes(normalised=True, as_objects=True)
+        logging.info('Done!')
+        return modes
 
-    def calc_spe_layer_guided(self, layer, roots_te=None, roots_tm=None, vg_te=None, vg_tm=None, z_step=1):
+    def calc_spe_layer_guided(self, layer, modes=None, z_step=1):
+        """
+        Evaluate the spontaneous emission rates into the guided modes for dipoles in a layer.
+        modes are the GuidedMode objects of both polarisations; they are only found (calc_guided_mode_objects)
+        if not given, e.g. when not called from calc_spe_structure_guided.
+        """
         assert self.d_list[layer] > 0, ValueError('Layer must have a thickness to use this function.')
-
-        # Only re-evaluate the guided roots and v_g if not passed to function. Computationally intensive.
-        # Will only be required if the function is not called from self.spe_structure_guided()
-        if all(arg is None for arg in (roots_te, roots_tm, vg_te, vg_tm)):
-            logging.info('Evaluating guided modes (k_11/k) and group velocity for each polarisation:')
-            logging.info('Finding TE modes')
-            self.set_polarization('TE')
-            roots_te = self.calc_guided_modes(normalised=True)
-            # Calculate group velocity for each mode
-            logging.info('Calculating group velocity for each mode...')
-            vg_te = self.calc_group_velocity()
-            logging.info('Done!')
-            logging.info('Finding TM modes')
-            self.set_polarization('TM')
-            roots_tm = self.calc_guided_modes(normalised=True)
-            # Calculate group velocity for each mode
-            logging.info('Calculating group velocity for each mode...')
-            vg_tm = self.calc_group_velocity()
-            logging.info('Done!')
+        if modes is None:
+            modes = self.calc_guided_mode_objects()
 
         # z positions to evaluate E at
         z = np.arange((z_step / 2.0), self.d_list[layer], z_step)
@@ -264,245 +339,73 @@ class SPE(TransferMatrix):
             # Therefore must propagate waves backwards in the first cladding.
             z = -z[::-1]
 
-        # Structure to hold field E(z) components of each mode for each dipole orientation for a given theta
-        electric_field = np.zeros(len(z), dtype=[('TE', 'complex128'),
-                                                 ('TM_p', 'complex128'),
-                                                 ('TM_s', 'complex128')])
+        spe = self._guided_rates(modes, np.full(len(z), layer), z)
+        return {'z': z, 'spe': spe}
 
-        # Structure to hold field SPE(z) components of each mode for each dipole orientation for a theta
+    @staticmethod
+    def _guided_rates(modes, layers, z, dz=None):
+        """
+        Sum the spontaneous emission rates into the guided modes at positions z within layers (one per z), or
+        averaged over the slabs of thickness dz centred at z (see GuidedMode.spe).
+        """
+        # Structure to hold field SPE(z) components of the modes for each dipole orientation
         spe = np.zeros(len(z), dtype=[('total', 'float64'),
                                       ('TE', 'float64'),
                                       ('TM_p', 'float64'),
-                                      ('TM_s', 'float64')])
-
-        # !* TE guided modes *!
-        self.set_polarization('TE')
-        self.set_field('E')
-        for n_11, v in zip(roots_te, vg_te):
-            self.set_mode_n_11(n_11)
-            assert self.mode_type() == 'Guided', ValueError('The mode you are trying to solve for is not Guided')
-
-            # Evaluate the normalisation (B4) and apply
-            norm = 0
-            for j in range(0, self.num_layers):
-                k, q, k_11 = self.calc_wave_vector_components(j)
-                a, b = self.layer_field_amplitudes(j)
-                if j == 0:
-                    chi = np.imag(q)
-                    norm += abs(b) ** 2 * (chi ** 2 + k_11 ** 2) / (2 * chi)
-                elif j == (self.num_layers - 1):
-                    chi = np.imag(q)
-                    norm += abs(a) ** 2 * (chi ** 2 + k_11 ** 2) / (2 * chi)
-                else:
-                    d = self.d_list[j]
-                    w1 = (k_11 ** 2 + q * conj(q)) * sinc((q - conj(q)) * d / 2)
-                    w2 = (k_11 ** 2 - q * conj(q)) * sinc((q + conj(q)) * d / 2)
-                    norm += d * (w1 * (abs(a) ** 2 + abs(b) ** 2) + w2 * (conj(a) * b + conj(b) * a))
-            assert np.isreal(norm) and norm > 0, ValueError('TE: Check Normalisation - should be real and > 0')
-
-            # E field coefficients in terms of layer 0 (superstrate) outgoing field amplitude
-            a, b = self.layer_field_amplitudes(layer)
-            a /= np.sqrt(norm)
-            b /= np.sqrt(norm)
-
-            # Wave vector components in layer
-            k, q, k_11 = self.calc_wave_vector_components(layer)
-            assert k_11 == (self.n_11 * self.k_vac), ValueError('Check TE')
-
-            # Evaluate E(z)
-            electric_field['TE'] = a * exp(1j * q * z) + b * exp(-1j * q * z)
-            spe['TE'] += abs(electric_field['TE']) ** 2 * (k_11 / v)
-        # Normalise emission rates to vacuum emission rate of a randomly orientated dipole
-        spe['TE'] *= 3 * pi * c / 4
-
-        # !* TM guided modes *!
-        self.set_polarization('TM')
-        self.set_field('H')
-        # Find guided modes parallel wave vector
-        for n_11, v in zip(roots_tm, vg_tm):
-            self.set_mode_n_11(n_11)
-            assert self.mode_type() == 'Guided', ValueError('The mode you are trying to solve for is not Guided')
-
-            # Evaluate the normalisation (B8) and apply
-            norm = 0
-            for j in range(0, self.num_layers):
-                k, q, k_11 = self.calc_wave_vector_components(j)
-                a, b = self.layer_field_amplitudes(j)
-                if j == 0:
-                    chi = np.imag(q)
-                    norm += abs(b) ** 2 / (2 * chi)
-                elif j == (self.num_layers - 1):
-                    chi = np.imag(q)
-                    norm += abs(a) ** 2 / (2 * chi)
-                else:
-                    d = self.d_list[j]
-                    w1 = (abs(a) ** 2 + abs(b) ** 2) * sinc((q - conj(q)) * d / 2)
-                    w2 = (conj(a) * b + conj(b) * a) * sinc((q + conj(q)) * d / 2)
-                    norm += d * (w1 + w2)
-            assert np.isreal(norm), ValueError('TM: Check Normalisation - should be real')
-
-            # E field coefficients in terms of layer 0 (superstrate) outgoing field amplitude
-            a, b = self.layer_field_amplitudes(layer)
-            a /= np.sqrt(norm)
-            b /= np.sqrt(norm)
-
-            # Wave vector components in layer (q, k_11 are angle dependent)
-            k, q, k_11 = self.calc_wave_vector_components(layer)
-            assert k_11 == (self.n_11 * self.k_vac), ValueError('Check TM')
-
-            # Calculate the electric field component perpendicular (s) and parallel (p) to the interface
-            eps = self.n_list[layer].real ** 2
-            electric_field['TM_s'] = (1j * k_11 / eps) * (a * exp(1j * q * z) + b * exp(-1j * q * z))
-            electric_field['TM_p'] = (1j * q / eps) * (-a * exp(1j * q * z) + b * exp(-1j * q * z))
-
-            spe['TM_s'] += abs(electric_field['TM_s']) ** 2 * (k_11 / v)
-            spe['TM_p'] += abs(electric_field['TM_p']) ** 2 * (k_11 / v)
-
-        # Normalise emission rates to vacuum emission rate of a randomly orientated dipole
-        spe['TM_s'] *= (3 * c * self.lam_vac ** 4) / (2 ** 5 * pi ** 3)
-        spe['TM_p'] *= (3 * c * self.lam_vac ** 4) / (2 ** 6 * pi ** 3)
-
-        return {'z': z, 'spe': spe}
-
-    def calc_spe_structure_guided(self, z_step=1):
-        assert self.supports_guiding(), ValueError('This structure does not support guided modes.')
-
-        # z positions to evaluate E field at over entire structure
-        z_pos = np.arange((z_step / 2.0), self.d_cumulative[-1], z_step)
-
-        # get z_mat - specifies what layer the corresponding point in z_pos is in
-        comp1 = np.kron(np.ones((self.num_layers, 1)), z_pos)
-        comp2 = np.transpose(np.kron(np.ones((len(z_pos), 1)), self.d_cumulative))
-        z_mat = sum(comp1 > comp2, 0)
-
-        # Structure to hold field spontaneous emission rate components over z
-        spe = np.zeros(len(z_pos), dtype=[('TE', 'float64'),
-                                          ('TM_p', 'float64'),
-                                          ('TM_s', 'float64'),
-                                          ('parallel', 'float64'),
-                                          ('perpendicular', 'float64'),
-                                          ('avg', 'float64')])
-
-        logging.info('Evaluating guided modes (k_11/k) and group velocity for each polarisation:')
-
-        logging.info('Finding TE modes...')
-        self.set_polarization('TE')
-        roots_te = self.calc_guided_modes(normalised=True)
-        logging.info('Calculating group velocity for each mode...')
-        vg_te = self.calc_group_velocity()
-        logging.info('Done!')
-        logging.info('Finding TM modes')
-        self.set_polarization('TM')
-        roots_tm = self.calc_guided_modes(normalised=True)
-        logging.info('Calculating group velocity for each mode...')
-        vg_tm = self.calc_group_velocity()
-        logging.info('Done!')
-
-        # if vg_te == 0 or vg_tm == 0:
-        #     # Average for a randomly orientated dipole
-        #     spe['avg'] = (2 / 3) * spe['parallel'] + (1 / 3) * spe['perpendicular']
-        #     return {'z': z_pos, 'spe': spe}
-
-        logging.info('Evaluating guided mode spontaneous emission profiles:')
-        for layer in range(min(z_mat), max(z_mat) + 1):
-            # logging.info simulation information to command line
-            if layer == 0:
-                logging.info('\tLayer -> lower cladding...')
-            elif layer == self.num_layers - 1:
-                logging.info('\tLayer -> upper cladding...')
-            else:
-                logging.info('\tLayer -> internal {0:d} / {1:d}...'.format(layer, self.num_layers - 2))
-
-            # Find indices corresponding to the layer we are evaluating
-            ind = np.where(z_mat == layer)
-
-            # Calculate lower leaky modes
-            spe_layer = self.calc_spe_layer_guided(layer, roots_te, roots_tm, vg_te, vg_tm)['spe']
-            spe['TE'][ind] += spe_layer['TE']
-            spe['TM_p'][ind] += spe_layer['TM_p']
-            spe['TM_s'][ind] += spe_layer['TM_s']
+                                      ('TM_s', 'float64'),
+                                      ('parallel', 'float64'),
+                                      ('perpendicular', 'float64'),
+                                      ('avg', 'float64')])
+        for mode in modes:
+            for key, rate in mode.spe(layers, z, dz).items():
+                spe[key] += rate
 
         # Totals
+        spe['total'] = spe['TE'] + spe['TM_p'] + spe['TM_s']
         spe['parallel'] = spe['TE'] + spe['TM_p']
         spe['perpendicular'] = spe['TM_s']
 
         # Average for a randomly orientated dipole
         spe['avg'] = (2 / 3) * spe['parallel'] + (1 / 3) * spe['perpendicular']
+        return spe
 
+    def calc_spe_structure_guided(self, z_step=1):
+        """
+        Evaluate the spontaneous emission rates into the guided modes vs z over the structure. The modes and
+        their normalisation are evaluated once and the rates of all the layers evaluated together.
+        """
+        assert self.supports_guiding(), ValueError('This structure does not support guided modes.')
+        z_pos, z_mat, z_local = self._structure_z(z_step)
+        modes = self.calc_guided_mode_objects()
+        logging.info('Evaluating guided mode spontaneous emission profiles...')
+        spe = self._guided_rates(modes, z_mat, z_local)
         return {'z': z_pos, 'spe': spe}
 
-    def calc_spe_layer(self, layer, th_pow=10, z_step=1):
+    def calc_spe_layer(self, layer, th_pow=10, z_step=1, workers=None):
         logging.info("Calculating leaky modes...")
 
-        # Calculate lower leaky modes
-        result = self.calc_spe_layer_leaky(layer, emission='Lower', th_pow=th_pow)
-        spe_layer = result['spe']
+        # Calculate lower and upper leaky modes (upper always leaky as n[0] > n[-1])
+        result = self.calc_spe_layer_leaky(layer, emission='Lower', th_pow=th_pow, z_step=z_step, workers=workers)
         z = result['z']
-        # Structure to hold field spontaneous emission rate components over z
-        leaky = np.zeros(len(z), dtype=[('total', 'float64'),
-                                        ('parallel', 'float64'),
-                                        ('perpendicular', 'float64'),
-                                        ('avg', 'float64'),
-                                        ('lower', 'float64'),
-                                        ('upper', 'float64'),
-                                        ('TE', 'float64'),
-                                        ('TM_p', 'float64'),
-                                        ('TM_s', 'float64'),
-                                        ('TE_lower', 'float64'),
-                                        ('TM_p_lower', 'float64'),
-                                        ('TM_s_lower', 'float64'),
-                                        ('TE_lower_full', 'float64'),
-                                        ('TM_p_lower_full', 'float64'),
-                                        ('TM_s_lower_full', 'float64'),
-                                        ('TE_lower_partial', 'float64'),
-                                        ('TM_p_lower_partial', 'float64'),
-                                        ('TM_s_lower_partial', 'float64'),
-                                        ('TE_upper', 'float64'),
-                                        ('TM_p_upper', 'float64'),
-                                        ('TM_s_upper', 'float64')])
-        leaky['TE_lower'] += spe_layer['TE']
-        leaky['TM_p_lower'] += spe_layer['TM_p']
-        leaky['TM_s_lower'] += spe_layer['TM_s']
-        leaky['TE_lower_full'] += spe_layer['TE_full']
-        leaky['TM_s_lower_full'] += spe_layer['TM_s_full']
-        leaky['TM_p_lower_full'] += spe_layer['TM_p_full']
-        leaky['TE_lower_partial'] += spe_layer['TE_partial']
-        leaky['TM_s_lower_partial'] += spe_layer['TM_s_partial']
-        leaky['TM_p_lower_partial'] += spe_layer['TM_p_partial']
-
-        # Calculate upper leaky modes (always leaky as n[0] > n[-1])
-        spe_layer = self.calc_spe_layer_leaky(layer, emission='Upper', th_pow=th_pow)['spe']
-        leaky['TE_upper'] += spe_layer['TE']
-        leaky['TM_p_upper'] += spe_layer['TM_p']
-        leaky['TM_s_upper'] += spe_layer['TM_s']
-
-        # Totals
-        leaky['TE'] = leaky['TE_lower'] + leaky['TE_upper']
-        leaky['TM_p'] = leaky['TM_p_lower'] + leaky['TM_p_upper']
-        leaky['TM_s'] = leaky['TM_s_lower'] + leaky['TM_s_upper']
-        leaky['lower'] = leaky['TE_lower'] + leaky['TM_p_lower'] + leaky['TM_s_lower']
-        leaky['upper'] = leaky['TE_upper'] + leaky['TM_p_upper'] + leaky['TM_s_upper']
-        leaky['total'] = leaky['TE'] + leaky['TM_p'] + leaky['TM_s']
-        leaky['parallel'] = leaky['TE'] + leaky['TM_p']
-        leaky['perpendicular'] = leaky['TM_s']
-
-        # Average for a randomly orientated dipole
-        leaky['avg'] = (2 / 3) * leaky['parallel'] + (1 / 3) * leaky['perpendicular']
+        upper = self.calc_spe_layer_leaky(layer, emission='Upper', th_pow=th_pow, z_step=z_step, workers=workers)
+        leaky = self._combine_spe_leaky(result['spe'], upper['spe'])
 
         logging.info('Done!')
 
         if self.supports_guiding():
             logging.info("Structure suppports waveguiding. Calculating guided modes...")
-            guided = self.calc_spe_layer_guided(layer, z_step)['spe']
+            guided = self.calc_spe_layer_guided(layer, z_step=z_step)['spe']
             logging.info('Done!')
             return {'z': z, 'leaky': leaky, 'guided': guided}
         else:
             logging.info("Structure does not support waveguiding.")
             return {'z': z, 'leaky': leaky}
 
-    def calc_spe_structure(self, th_pow=10, z_step=1):
+    @cached
+    def calc_spe_structure(self, th_pow=10, z_step=1, quadrature='romb', tol=1e-6, workers=None):
         logging.info("Calculating leaky modes...")
-        result = self.calc_spe_structure_leaky(th_pow=th_pow, z_step=z_step)
+        result = self.calc_spe_structure_leaky(th_pow=th_pow, z_step=z_step, quadrature=quadrature, tol=tol,
+                                               workers=workers)
         z = result['z']
         leaky = result['spe']
         logging.info('Done!')
@@ -517,8 +420,122 @@ class SPE(TransferMatrix):
             logging.info("Structure does not support waveguiding.")
             return {'z': z, 'leaky': leaky, 'total': leaky['avg']}
 
+    @cached
+    def calc_spe_points(self, z, th_pow=10, quadrature='romb', tol=1e-6, workers=None):
+        """
+        Evaluate the leaky and guided mode spontaneous emission rates only at the dipole positions (or sheets) z,
+        measured from the bottom of the structure as the z of calc_spe_structure. Positions outside of the
+        structure are in the semi-infinite claddings. Costs the same number of angles as calc_spe_structure
+        but only len(z) positions, e.g. for sweeps that need the rate at a few depths.
+        See calc_spe_layer_leaky for the options. Returns a dict as calc_spe_structure.
+        """
+        z = np.atleast_1d(np.asarray(z, dtype=float))
+        assert z.ndim == 1, ValueError('z must be a 1D array of positions.')
+        z_mat, z_local = self._locate_z(z)
+
+        logging.info('Evaluating lower and upper leaky modes at {} positions...'.format(len(z)))
+        result = {'z': z}
+        with process_pool(workers) as executor:
+            result.update(self._calc_spe_rates(z_local, z_mat, None, th_pow, quadrature, tol, executor))
+        return result
+
+    @cached
+    def calc_spe_layer_average(self, layers=None, th_pow=10, quadrature='romb', tol=1e-6, workers=None):
+        """
+        Evaluate the leaky and guided mode spontaneous emission rates averaged over each of the layers (all the
+        layers with a thickness by default). The averages are exact: the squared fields are integrated over the
+        layers in closed form from the field amplitudes (see mean_squared), so they don't depend on a z grid.
+        See calc_spe_layer_leaky for the options. Returns a dict as calc_spe_structure with 'layer' instead of
+        'z', e.g. the layer averaged Purcell factor is result['total'].
+        """
+        layers = np.flatnonzero(self.d_list > 0) if layers is None else np.atleast_1d(layers)
+        z, dz = layer_interval(self.d_list, layers)
+        assert np.all(dz > 0), ValueError('Layer must have a thickness to use this function.')
+
+        logging.info('Evaluating layer averaged lower and upper leaky modes...')
+        result = {'layer': layers}
+        with process_pool(workers) as executor:
+            result.update(self._calc_spe_rates(z, layers, dz, th_pow, quadrature, tol, executor))
+        return result
+
+    @cached
+    def calc_spe_structure_with_averages(self, layers=None, th_pow=10, z_step=1, quadrature='romb', tol=1e-6,
+                                         workers=None):
+        """
+        Evaluate the leaky and guided mode spontaneous emission rates over the structure (on the z grid of
+        calc_spe_structure) and their exact averages over each of the layers (see calc_spe_layer_average) in a
+        single pass. Returns a dict as calc_spe_structure, with the layer averages in 'average'.
+        """
+        layers = np.flatnonzero(self.d_list > 0) if layers is None else np.atleast_1d(layers)
+        centre, dz = layer_interval(self.d_list, layers)
+        assert np.all(dz > 0), ValueError('Layer must have a thickness to use this function.')
+        z_pos, z_mat, z_local = self._structure_z(z_step)
+
+        logging.info('Evaluating lower and upper leaky modes over the structure and its layers...')
+        with process_pool(workers) as executor:
+            rates = self._calc_spe_rates(np.append(z_local, centre), np.append(z_mat, layers),
+                                         np.append(np.zeros(len(z_local)), dz), th_pow, quadrature, tol, executor)
+        result = {'z': z_pos, 'average': {'layer': layers}}
+        for key, value in rates.items():
+            result[key] = value[:len(z_pos)]
+            result['average'][key] = value[len(z_pos):]
+        return result
+
+    def _calc_spe_rates(self, z, layers, dz=None, th_pow=10, quadrature='romb', tol=1e-6, executor=None):
+        """
+        Evaluate the leaky and guided mode emission rates at positions z (local to layers, as _locate_z), or
+        averaged over the slabs of thicknesses dz centred at z, where dz = 0 gives the rate at z.
+        Returns {'leaky', 'guided', 'total'}, with 'guided' only if the structure supports guiding.
+        """
+        spe_lower, _ = self._calc_spe_leaky(z, layers, 'Lower', th_pow, quadrature, tol, executor, dz)
+        spe_upper, _ = self._calc_spe_leaky(z, layers, 'Upper', th_pow, quadrature, tol, executor, dz)
+        leaky = self._combine_spe_leaky(spe_lower, spe_upper)
+
+        if self.supports_guiding():
+            guided = self._guided_rates(self.calc_guided_mode_objects(), layers, z, dz)
+            return {'leaky': leaky, 'guided': guided, 'total': leaky['avg'] + guided['avg']}
+        else:
+            return {'leaky': leaky, 'total': leaky['avg']}
+
+    def calc_spe_profile(self, density, layer=None, z_range=None, num=32, th_pow=10, quadrature='romb', tol=1e-6,
+                         workers=None):
+        """
+        Evaluate the emission rates averaged over an emitter depth profile (e.g. implanted ions), with the
+        emission rates only evaluated at the nodes of a quadrature matched to the profile (see depth_quadrature):
+        num Gauss-Legendre nodes per layer, subdivided until the profile is resolved, for an analytic density(z)
+        or a linearly interpolated tabulated profile (z, density). z is measured from the bottom of the structure as for calc_spe_structure, and the
+        profile is averaged over layer, z_range, the tabulated range or the whole structure.
+
+        Returns a dict holding the profile averaged 'leaky' (and 'guided') rates as structured arrays of one
+        element, the averaged 'total' rate (i.e. the profile weighted Purcell factor relative to vacuum), and
+        the quadrature nodes 'z' and normalised 'weights'. See calc_spe_layer_leaky for the other options.
+        """
+        z, weights = depth_quadrature(self.d_list, density, layer, z_range, num)
+        logging.info('Averaging over the emitter profile with {} positions...'.format(len(z)))
+        points = self.calc_spe_points(z, th_pow=th_pow, quadrature=quadrature, tol=tol, workers=workers)
+
+        result = {'z': z, 'weights': weights, 'total': np.dot(weights, points['total'])}
+        for key in ['leaky', 'guided']:
+            if key in points:
+                spe = np.zeros(1, dtype=points[key].dtype)
+                for name in spe.dtype.names:
+                    spe[name] = np.dot(weights, points[key][name])
+                result[key] = spe
+        return result
+
 
 # Helper Functions
+def process_pool(workers=None):
+    """
+    Return a process pool of the given number of workers to use as a context manager, or a null context
+    (serial evaluation, executor None) if workers is None or 1.
+    """
+    if workers is None or workers == 1:
+        return nullcontext()
+    assert isinstance(workers, int) and workers > 1, ValueError('workers must be a positive integer.')
+    return ProcessPoolExecutor(max_workers=workers)
+
+
 def plot_two_structures(st1, st2, result1, result2, param):
     fig, ax1 = plt.subplots()
     ax1.plot(result1['z'], result1[param], label='St1')
@@ -533,20 +550,67 @@ def plot_two_structures(st1, st2, result1, result2, param):
     # plt.show()
 
 
+def purcell_factors(reference, tests, layer, reference_layer=None, th_pow=11, z_step=1, quadrature='romb', tol=1e-6,
+                    workers=None):
+    """
+    Headless batch evaluation of the Purcell factors of many test structures relative to one reference structure
+    (e.g. films vs bare glass), for emitters in layer of the test structures and reference_layer (layer by
+    default) of the reference. The reference is computed once and the test structures are run on a pool of
+    workers processes (serially by default). Nothing is printed or plotted.
+
+    Returns a dict of arrays holding
+        'fp': the layer averaged Purcell factor of each test structure (ratio of the exact layer averaged
+              total emission rates, see calc_spe_layer_average),
+        'z': depths into the layer, measured from its lower boundary, on a grid of step z_step,
+        'fp_z': the z resolved Purcell factors, shape (len(tests), len(z)), nan beyond the thickness of the layer
+                of a test structure,
+        'rate', 'rate_z': the total emission rates of the test structures (layer averaged and z resolved),
+        'reference', 'reference_z': the same for the reference structure.
+    The reference layer must be at least as thick as the layers of the test structures.
+    """
+    reference_layer = layer if reference_layer is None else reference_layer
+    thickness = np.array([st.d_list[layer] for st in tests])
+    assert np.all(thickness > 0), ValueError('Layer must have a thickness to use this function.')
+    assert reference.d_list[reference_layer] >= np.max(thickness), \
+        ValueError('The reference layer must be at least as thick as the layers of the test structures.')
+    z = np.arange((z_step / 2.0), np.max(thickness), z_step)
+
+    logging.info('Evaluating the reference structure...')
+    reference_avg, reference_z = _purcell_rates(reference, reference_layer, z, th_pow, quadrature, tol)
+
+    logging.info('Evaluating {} test structures...'.format(len(tests)))
+    rate = np.empty(len(tests))
+    rate_z = np.full((len(tests), len(z)), np.nan)
+    with process_pool(workers) as executor:
+        results = (map if executor is None else executor.map)(
+            partial(_purcell_rates, th_pow=th_pow, quadrature=quadrature, tol=tol),
+            tests, [layer] * len(tests), [z[z < d] for d in thickness])
+        for i, (avg, rates) in enumerate(results):
+            rate[i] = avg
+            rate_z[i, :len(rates)] = rates
+    return {'fp': rate / reference_avg, 'z': z, 'fp_z': rate_z / reference_z, 'rate': rate, 'rate_z': rate_z,
+            'reference': reference_avg, 'reference_z': reference_z}
+
+
+def _purcell_rates(st, layer, z, th_pow, quadrature, tol):
+    # Layer averaged total emission rate and the rates at depths z into the layer, evaluated in the same pass
+    centre, d = layer_interval(st.d_list, layer)
+    z_mat, z_local = st._locate_z(np.append(0, st.d_cumulative)[layer] + z)
+    total = st._calc_spe_rates(np.append(centre, z_local), np.append(layer, z_mat), np.append(d, np.zeros(len(z))),
+                               th_pow, quadrature, tol)['total']
+    return total[0], total[1:]
+
+
 def purcell_factor(st1, st2, layer):
-    result1 = st1.calc_spe_structure(th_pow=11)
+    result1 = st1.calc_spe_structure_with_averages(layer, th_pow=11)
     spe1 = result1['total']
     ind1 = st1.get_layer_position_indices(layer)
-    # Average layer SPE rate
-    fp1 = np.mean(spe1[ind1])
 
-    result2 = st2.calc_spe_structure(th_pow=11)
+    result2 = st2.calc_spe_structure_with_averages(layer, th_pow=11)
     spe2 = result2['total']
     ind2 = st2.get_layer_position_indices(layer)
-    # Average layer SPE rate
-    fp2 = np.mean(spe2[ind2])
     # Average layer purcell factor
-    fp = fp2 / fp1
+    fp = result2['average']['total'][0] / result1['average']['total'][0]
     print('Avg. Purcell Factor over layer = {:e}'.format(fp))
 
     # Plot the SPE avg for each structure vs z
@@ -0,0 +1,116 @@
+import itertools
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from lifetmm.HelperFunctions import atomic_write
+
+log = logging.getLogger(__name__)
+
+
+def sweep_points(grid):
+    """ Return the points of grid (dict of parameter name -> values) as a list of dicts, last parameter fastest. """
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def run_sweep(build, evaluate, grid, path, workers=None, verbose=True):
+    """
+    Run a parameter sweep over the points of grid, where build(**params) returns the structure of a point and
+    evaluate(structure) its results as a (nested) dict. Every point is saved to its own file in path as soon
+    as it finishes, so running the sweep again (e.g. after a crash) only runs the missing points.
+    With workers > 1 the points run on a process pool (build and evaluate must be picklable).
+    Returns load_sweep(path).
+    """
+    points = sweep_points(grid)
+    os.makedirs(path, exist_ok=True)
+
+    # The grid of an existing sweep must match, otherwise the saved points would be mixed up
+    grid_file = os.path.join(path, 'sweep.npz')
+    if os.path.isfile(grid_file):
+        saved = _load_grid(path)
+        assert list(saved) == list(grid) and all(np.array_equal(saved[name], grid[name]) for name in grid), \
+            ValueError('{} holds a sweep over a different grid.'.format(path))
+    else:
+        names = np.array(list(grid))
+        atomic_write(grid_file, lambda f: np.savez(f, names=names, **{name: grid[name] for name in grid}))
+
+    todo = [i for i in range(len(points)) if not os.path.isfile(_point_file(path, i))]
+    if verbose:
+        logging.info('Sweep: {} points, {} already done.'.format(len(points), len(points) - len(todo)))
+
+    if workers is None or workers == 1:
+        for num, i in enumerate(todo, start=1):
+            _run_point(build, evaluate, points[i], _point_file(path, i))
+            if verbose:
+                logging.info('Sweep point {} done ({}/{}).'.format(i, num, len(todo)))
+    else:
+        assert isinstance(workers, int) and workers > 1, ValueError('workers must be a positive integer.')
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(_run_point, build, evaluate, points[i], _point_file(path, i)): i
+                       for i in todo}
+            for num, future in enumerate(as_completed(futures), start=1):
+                future.result()
+                if verbose:
+                    logging.info('Sweep point {} done ({}/{}).'.format(futures[future], num, len(todo)))
+    return load_sweep(path)
+
+
+def load_sweep(path):
+    """
+    Load the (possibly incomplete) sweep saved in path by run_sweep.
+    Returns {'params', 'done', 'results'}, with None as the result of the points that have not finished.
+    """
+    grid = _load_grid(path)
+    points = sweep_points(grid)
+    results = [load_point(_point_file(path, i)) if os.path.isfile(_point_file(path, i)) else None
+               for i in range(len(points))]
+    params = {name: np.array([point[name] for point in points]) for name in grid}
+    return {'params': params, 'done': np.array([result is not None for result in results], dtype=bool),
+            'results': results}
+
+
+def load_point(filename):
+    """ Load the result of a sweep point, as returned by evaluate, with its parameter values in 'params'. """
+    result = {}
+    with np.load(filename) as data:
+        for key in data.files:
+            # Rebuild the nested dicts
+            *parents, name = key.split('/')
+            d = result
+            for parent in parents:
+                d = d.setdefault(parent, {})
+            d[name] = data[key][()] if data[key].ndim == 0 else data[key]
+    return result
+
+
+def _load_grid(path):
+    # Parameter grid of the sweep in path, in the order of the parameters
+    with np.load(os.path.join(path, 'sweep.npz')) as data:
+        return {str(name): data[name] for name in data['names']}
+
+
+def _point_file(path, index):
+    return os.path.join(path, 'point_{:06d}.npz'.format(index))
+
+
+def _flatten(d, prefix=''):
+    # Flatten nested dicts into {'parent/name': value}
+    items = {}
+    for key, value in d.items():
+        if isinstance(value, dict):
+            items.update(_flatten(value, prefix + key + '/'))
+        else:
+            items[prefix + key] = np.asarray(value)
+    return items
+
+
+def _run_point(build, evaluate, params, filename):
+    # Evaluate one sweep point and save it
+    result = evaluate(build(**params))
+    assert isinstance(result, dict), ValueError('evaluate must return a dict.')
+    items = _flatten({'params': params})
+    items.update(_flatten(result))
+    atomic_write(filename, lambda f: np.savez(f, **items))
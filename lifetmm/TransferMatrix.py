@@ -6,14 +6,16 @@ Transfer matrix model for light inside a multilayer dielectric structure.
 """
 
 import logging
-import time
 
 import matplotlib.pyplot as plt
 import numpy as np
 from numpy import pi, sqrt, sin, exp
 from scipy.constants import c
 
-from lifetmm.HelperFunctions import roots, snell, det
+from lifetmm.Cache import cached
+from lifetmm.Fields import FieldProfile
+from lifetmm.GuidedModes import GuidedMode
+from lifetmm.HelperFunctions import grid_roots, contour_roots, snell, fresnel, t_to_s, redheffer, chebyshev_power, redheffer_power
 
 log = logging.getLogger(__name__)
 
@@ -25,6 +27,8 @@ class TransferMatrix:
         self.n_list = np.array([], dtype=complex)
         self.d_cumulative = np.array([], dtype=float)
         self.num_layers = 0
+        # Periodic blocks of layers (start layer, layers per unit cell, number of periods)
+        self.periods = []
         # Light parameters
         self.lam_vac = np.nan
         self.k_vac = np.nan
@@ -33,6 +37,17 @@ class TransferMatrix:
         self.pol = 'TE'
         self.th = 0  # Angle of incidence from normal to multilayer [Leaky modes only]
         self.n_11 = 0  # Normalised parallel wave vector (or n_eff as used with guided modes )
+        # Matrix formalism used to solve the structure ('transfer' or 'scattering')
+        self.formalism = 'transfer'
+        # Field amplitudes of every layer for the current n_11, pol, field and wavelength
+        self._amplitude_cache = None
+        self._partials_cache = {}
+
+    def __getstate__(self):
+        # Don't pickle the cached partial S matrices (e.g. when sending the structure to worker processes)
+        state = self.__dict__.copy()
+        state['_partials_cache'] = {}
+        return state
 
     def add_layer(self, d, n):
         """
@@ -52,6 +67,52 @@ class TransferMatrix:
         self.d_cumulative = np.cumsum(self.d_list)
         self.num_layers = np.size(self.d_list)
 
+    def add_layers(self, d, n):
+        """
+        Add a sequence of layers with thicknesses d and refractive indices n (array-likes of equal
+        length) to the structure in one go. Validated once and stored contiguously, so building
+        structures with thousands of (sub)layers costs O(L) rather than O(L^2) with add_layer.
+        """
+        d = np.asarray(d)
+        n = np.asarray(n)
+        assert d.ndim == 1 and d.shape == n.shape, ValueError('d and n must be 1D arrays of the same length.')
+        assert np.all(np.isreal(d)), ValueError('Thickness d must be either an integer or a float.')
+        d = d.real.astype(float)
+        assert np.all(d >= 0), ValueError('Thickness must >= 0.')
+        assert np.issubdtype(n.dtype, np.number), \
+            ValueError('Refractive index n must be either an integer, float or complex number.')
+        if self.num_layers == 0 and n.size > 0:
+            assert np.isreal(n[0]), ValueError('Incomming medium must be transparent (n is real).')
+        self.d_list = np.concatenate((self.d_list, d))
+        self.n_list = np.concatenate((self.n_list, n.astype(complex)))
+        # Recalculate structure info
+        self.d_cumulative = np.cumsum(self.d_list)
+        self.num_layers = np.size(self.d_list)
+
+    def add_periodic_layers(self, d, n, num_periods):
+        """
+        Add num_periods repeats of a unit cell of layers with thicknesses d and refractive indices n,
+        e.g. a distributed Bragg reflector with d=[d_h, d_l], n=[n_h, n_l].
+
+        The block is remembered so that the system matrix raises the unit cell matrix to the
+        power num_periods in closed form; the cost is the same for 5 or 500 periods.
+        """
+        assert isinstance(num_periods, (int, np.integer)) and num_periods >= 0, \
+            ValueError('num_periods must be an integer >= 0.')
+        start = self.num_layers
+        self.add_layers(np.tile(d, num_periods), np.tile(n, num_periods))
+        if num_periods > 1:
+            self.periods.append((start, np.size(d), num_periods))
+
+    @classmethod
+    def from_layers(cls, d, n):
+        """
+        Create a structure from whole arrays of layer thicknesses d and refractive indices n.
+        """
+        st = cls()
+        st.add_layers(d, n)
+        return st
+
     def set_vacuum_wavelength(self, lam_vac):
         """
         Set the vacuum wavelength to be simulated.
@@ -81,6 +142,17 @@ class TransferMatrix:
         assert field in ['E', 'H'], ValueError("The field must be either 'E' of 'H'.")
         self.field = field
 
+    def set_formalism(self, formalism):
+        """
+        Set the matrix formalism used to solve the structure. Either 'transfer' (default) or 'scattering'.
+        The scattering matrix (Redheffer star product) formalism only combines bounded quantities so it
+        does not overflow for thick absorbing layers or evanescent waves. Reflection/transmission coefficients
+        and field amplitudes are identical. The guided mode search (calc_s11_batch) is bounded in both.
+        """
+        assert formalism in ['transfer', 'scattering'], \
+            ValueError("The formalism must be either 'transfer' or 'scattering'.")
+        self.formalism = formalism
+
     def set_incident_angle(self, th, units='radians'):
         """
         Set the incident angle of the plane wave (for a leaky mode). 0 deg is normal to the interface.
@@ -114,7 +186,11 @@ class TransferMatrix:
         Note: Can be complex for use in fresnel equations when calculating interference matrix (metal layers).
         """
         nj = self.n_list[j]  # Normalised (complex) layer wave-vector magnitude (k(j)/k_vac)
-        return sqrt(nj ** 2 - self.n_11 ** 2)
+        xi = sqrt(nj ** 2 - self.n_11 ** 2)
+        # Bound (decaying) solutions in the claddings for complex guided n_11. No-op for real n_11.
+        if j in [0, self.num_layers - 1] and xi.imag < 0 and np.real(self.n_11) > nj.real:
+            xi = -xi
+        return xi
 
     def calc_k(self, j):
         """
@@ -157,20 +233,8 @@ class TransferMatrix:
         nk = self.n_list[k]
         qj = self.calc_xi(j)  # Using q notation instead of xi to match eq 3a and 3b in [1]
         qk = self.calc_xi(k)  # Ditto
-        # Evaluate reflection and transmission coefficients for E field - ok for complex index of refraction [1]
-        if self.pol in ['p', 'TM']:
-            # Note r_p is defined where the E field flips direction by pi on reflection. See Fig 2.2 in [2].
-            r = (nk ** 2 * qj - nj ** 2 * qk) / (nk ** 2 * qj + nj ** 2 * qk)
-            t = (2 * nj * nk * qj) / (qj * nk ** 2 + qk * nj ** 2)
-        elif self.pol in ['s', 'TE']:
-            r = (qj - qk) / (qj + qk)
-            t = (2 * qj) / (qj + qk)
-        else:
-            raise ValueError('A polarisation for the field must be set.')
-        if self.field == 'H':
-            # Convert transmission coefficient for E field to that of the H field.
-            # The reflection coefficient is the same as the medium does not change.
-            t *= nk / nj
+        # Evaluate reflection and transmission coefficients for E (or H) field - ok for complex index of refraction [1]
+        r, t = fresnel(nj, nk, qj, qk, self.pol, self.field)
         if t == 0:
             logging.debug('Transmission of i_matrix = 0. Returning inf.')
             return np.array([[np.inf, np.inf], [np.inf, np.inf]], dtype=complex)
@@ -184,7 +248,7 @@ class TransferMatrix:
         qj = self.calc_q(j)
         dj = self.d_list[j]
         assert dj > 0, ValueError('Layer {} does not have a thickness.'.format(j))
-        assert exp(-1j * qj * dj) < np.finfo(np.complex).max, ValueError('l_matrix is unstable.')
+        assert np.isfinite(exp(-1j * qj * dj)), ValueError('l_matrix is unstable. Try set_formalism(\'scattering\').')
         return np.array([[exp(-1j * qj * dj), 0], [0, exp(1j * qj * dj)]], dtype=complex)
 
     def s_matrix(self):
@@ -220,62 +284,407 @@ class TransferMatrix:
             s_dprime = s_dprime @ l @ i
         return s_dprime
 
+    def calc_xi_batch(self, j, n_11):
+        """
+        Normalised perpendicular wave-vector in layer j for an array of n_11 values.
+        """
+        nj = self.n_list[j]
+        n_11 = np.asarray(n_11)
+        xi = sqrt(nj ** 2 - n_11 ** 2)
+        if j in [0, self.num_layers - 1] and np.iscomplexobj(n_11):
+            # Bound (decaying) solutions in the claddings for complex guided n_11 (see calc_xi)
+            xi = np.where((xi.imag < 0) & (n_11.real > nj.real), -xi, xi)
+        return xi
+
+    def i_matrix_batch(self, j, k, n_11, pol=None, field=None):
+        """
+        Returns the interference matrices between layers j and k for an array of n_11 values.
+        The matrices are stacked along the leading axes, i.e. the result has shape n_11.shape + (2, 2).
+        The polarisation and field default to those set on the structure.
+        """
+        pol = self.pol if pol is None else pol
+        field = self.field if field is None else field
+        qj = self.calc_xi_batch(j, n_11)
+        qk = self.calc_xi_batch(k, n_11)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r, t = fresnel(self.n_list[j], self.n_list[k], qj, qk, pol, field)
+            inv_t = 1 / t
+            m = np.empty(np.shape(t) + (2, 2), dtype=complex)
+            m[..., 0, 0] = m[..., 1, 1] = inv_t
+            m[..., 0, 1] = m[..., 1, 0] = r * inv_t
+        # Match i_matrix: zero transmission gives an infinite matrix
+        m[t == 0] = np.inf
+        return m
+
+    def l_matrix_batch(self, j, n_11, k_vac=None, scaled=False):
+        """
+        Returns the propagation L matrices for layer j for an array of n_11 values.
+        k_vac defaults to the vacuum wavevector of the structure and may be an array
+        that broadcasts against n_11 (e.g. for wavelength sweeps).
+        scaled=True divides the matrices by exp(|Im(q_j)| d_j), which keeps them bounded for thick
+        evanescent or absorbing layers.
+        """
+        k_vac = self.k_vac if k_vac is None else k_vac
+        assert not np.any(np.isnan(k_vac)), ValueError('Wavevector not defined. Please set the vacuum wavelength.')
+        dj = self.d_list[j]
+        assert dj > 0, ValueError('Layer {} does not have a thickness.'.format(j))
+        qj = self.calc_xi_batch(j, n_11) * k_vac
+        m = np.zeros(np.shape(qj) + (2, 2), dtype=complex)
+        decay = abs(qj.imag) * dj if scaled else 0
+        m[..., 0, 0] = exp(-1j * qj * dj - decay)
+        m[..., 1, 1] = exp(1j * qj * dj - decay)
+        return m
+
+    def s_matrix_batch(self, n_11, pol=None, field=None, k_vac=None, scaled=False):
+        """
+        Returns the total system transfer matrices for an array of n_11 values in one vectorized pass.
+        The result has shape broadcast(n_11, k_vac).shape + (2, 2).
+        scaled=True uses the scaled propagation matrices (see l_matrix_batch).
+        """
+        return self._system_matrix_batch(n_11, pol, field, k_vac, scattering=False, scaled=scaled)
+
+    def _periodic_blocks(self):
+        """
+        Return {start: (cell_len, num_periods)} of the periodic blocks that lie entirely inside the
+        structure (between the claddings), trimming periods that overlap a cladding. Blocks that are no
+        longer the unit cell repeated (e.g. after editing d_list or n_list in place) are left out.
+        """
+        blocks = {}
+        for start, cell_len, num_periods in self.periods:
+            if start == 0:
+                start += cell_len
+                num_periods -= 1
+            num_periods = min(num_periods, (self.num_layers - 1 - start) // cell_len)
+            end = start + cell_len * num_periods
+            periodic = all(np.array_equal(x[start:end], np.tile(x[start:start + cell_len], num_periods))
+                           for x in [self.d_list, self.n_list])
+            if num_periods > 1 and periodic:
+                blocks[start] = (cell_len, num_periods)
+        return blocks
+
+    def _system_matrix_batch(self, n_11, pol, field, k_vac, scattering, scaled=False):
+        """
+        Total system transfer (or scattering) matrices for an array of n_11 values. Periodic blocks
+        (see add_periodic_layers) are evaluated as the unit cell matrix raised to the number of periods.
+        """
+        if scattering:
+            interface, propagate, product, power = self.i_smatrix_batch, self.p_smatrix_batch, redheffer, redheffer_power
+        else:
+            interface, power = self.i_matrix_batch, chebyshev_power
+
+            def propagate(j, n_11, k_vac):
+                return self.l_matrix_batch(j, n_11, k_vac, scaled)
+
+            def product(a, b):
+                return a @ b
+        blocks = self._periodic_blocks()
+        s = interface(0, 1, n_11, pol, field)
+        j = 1
+        while j < self.num_layers - 1:
+            if j in blocks:
+                cell_len, num_periods = blocks[j]
+                # Unit cell from the start of its first layer back into the (identical) first layer
+                cell = product(propagate(j, n_11, k_vac), interface(j, j + 1 if cell_len > 1 else j, n_11, pol, field))
+                for k in range(j + 1, j + cell_len):
+                    nxt = k + 1 if k < j + cell_len - 1 else j
+                    cell = product(product(cell, propagate(k, n_11, k_vac)), interface(k, nxt, n_11, pol, field))
+                end = j + cell_len * num_periods
+                s = product(product(s, power(cell, num_periods)), interface(j, end, n_11, pol, field))
+                j = end
+            else:
+                s = product(product(s, propagate(j, n_11, k_vac)), interface(j, j + 1, n_11, pol, field))
+                j += 1
+        return s
+
+    def s_matrix_derivatives_batch(self, n_11, pol=None, field=None, scaled=False):
+        """
+        Returns the total system transfer matrices for an array of n_11 values together with their
+        (exact) derivatives with respect to n_11 and k_vac, (s, ds/dn_11, ds/dk_vac).
+        The derivatives are carried through the matrix product with the product rule (forward mode).
+        scaled=True uses the scaled propagation matrices (see l_matrix_batch) and leaves out the derivatives
+        of the scale factors, which is exact for s_11 where s_11 = 0 (guided modes).
+
+        Interface matrices only depend on n_11: 1/t and r/t are linear in u = q_k/q_j for both
+        polarisations and fields, so d(1/t) = -d(r/t) = (1 - r)/(2t) * n_11 (1/q_j^2 - 1/q_k^2) dn_11.
+        Propagation matrices give dL = diag(-i, i) d_j L (q_j dk_vac + k_vac dq_j), dq_j = -n_11/q_j dn_11.
+        """
+        pol = self.pol if pol is None else pol
+        field = self.field if field is None else field
+        n_11 = np.asarray(n_11)
+        q = [self.calc_xi_batch(j, n_11) for j in range(self.num_layers)]
+
+        def interface(j, k):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                r, t = fresnel(self.n_list[j], self.n_list[k], q[j], q[k], pol, field)
+                d_inv_t = (1 - r) / (2 * t) * n_11 * (1 / q[j] ** 2 - 1 / q[k] ** 2)
+            m = np.empty(np.shape(t) + (2, 2), dtype=complex)
+            m[..., 0, 0] = m[..., 1, 1] = 1 / t
+            m[..., 0, 1] = m[..., 1, 0] = r / t
+            dm = np.empty_like(m)
+            dm[..., 0, 0] = dm[..., 1, 1] = d_inv_t
+            dm[..., 0, 1] = dm[..., 1, 0] = -d_inv_t
+            return m, dm
+
+        s, s_n = interface(0, 1)
+        s_k = np.zeros_like(s)
+        for j in range(1, self.num_layers - 1):
+            l = self.l_matrix_batch(j, n_11, scaled=scaled)
+            # Derivative of the phase q_j k_vac d_j with respect to n_11 and k_vac
+            phase_n = -n_11 / q[j] * self.k_vac * self.d_list[j]
+            phase_k = q[j] * self.d_list[j]
+            sign = np.array([-1j, 1j])
+            l_n = l * (sign * phase_n[..., None])[..., None]
+            l_k = l * (sign * phase_k[..., None])[..., None]
+            i, i_n = interface(j, j + 1)
+            sl = s @ l
+            # Product rule for s @ l @ i
+            s_n = (s_n @ l + s @ l_n) @ i + sl @ i_n
+            s_k = (s_k @ l + s @ l_k) @ i
+            s = sl @ i
+        return s, s_n, s_k
+
+    def calc_r_and_t_batch(self, n_11, pol=None, field=None, k_vac=None):
+        """
+        Return arrays of the complex reflection and transmission coefficients of the structure
+        for an array of n_11 values.
+        """
+        if self.formalism == 'scattering':
+            s = self.scattering_matrix_batch(n_11, pol, field, k_vac)
+            return s[..., 0, 0], s[..., 1, 0]
+        s = self.s_matrix_batch(n_11, pol, field, k_vac)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r = s[..., 1, 0] / s[..., 0, 0]
+            t = 1 / s[..., 0, 0]
+        return r, t
+
+    def i_smatrix_batch(self, j, k, n_11, pol=None, field=None):
+        """
+        Returns the interface scattering matrices [[r_jk, t_kj], [t_jk, r_kj]] between layers j and k
+        for an array of n_11 values, with shape n_11.shape + (2, 2).
+        """
+        pol = self.pol if pol is None else pol
+        field = self.field if field is None else field
+        nj = self.n_list[j]
+        nk = self.n_list[k]
+        qj = self.calc_xi_batch(j, n_11)
+        qk = self.calc_xi_batch(k, n_11)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r_jk, t_jk = fresnel(nj, nk, qj, qk, pol, field)
+            r_kj, t_kj = fresnel(nk, nj, qk, qj, pol, field)
+        m = np.empty(np.shape(r_jk) + (2, 2), dtype=complex)
+        m[..., 0, 0] = r_jk
+        m[..., 0, 1] = t_kj
+        m[..., 1, 0] = t_jk
+        m[..., 1, 1] = r_kj
+        return m
+
+    def p_smatrix_batch(self, j, n_11, k_vac=None):
+        """
+        Returns the propagation scattering matrices [[0, p], [p, 0]] for layer j, p = exp(i q_j d_j),
+        for an array of n_11 values. |p| <= 1 for absorbing or evanescent layers so it can not overflow.
+        """
+        k_vac = self.k_vac if k_vac is None else k_vac
+        assert not np.any(np.isnan(k_vac)), ValueError('Wavevector not defined. Please set the vacuum wavelength.')
+        dj = self.d_list[j]
+        assert dj > 0, ValueError('Layer {} does not have a thickness.'.format(j))
+        qj = self.calc_xi_batch(j, n_11) * k_vac
+        m = np.zeros(np.shape(qj) + (2, 2), dtype=complex)
+        m[..., 0, 1] = m[..., 1, 0] = exp(1j * qj * dj)
+        return m
+
+    def scattering_matrix_batch(self, n_11, pol=None, field=None, k_vac=None):
+        """
+        Returns the total system scattering matrices [[r, t_minus], [t, r_minus]] for an array of n_11
+        values, built with the Redheffer star product. Shape broadcast(n_11, k_vac).shape + (2, 2).
+        """
+        return self._system_matrix_batch(n_11, pol, field, k_vac, scattering=True)
+
+    def partial_scattering_matrices_batch(self, n_11, pol=None, field=None, k_vac=None):
+        """
+        Returns all the partial system scattering matrices for an array of n_11 values in one O(L) pass.
+        left[j] is the scattering matrix of layers 0 to j (the s_prime system, j >= 1) and right[j] that of
+        layers j to the end from the right boundary of layer j (the s_dprime system, j <= num_layers - 2).
+        The unused left[0] and right[-1] are those of an empty system.
+        """
+        num_layers = self.num_layers
+        shape = np.broadcast(n_11, self.k_vac if k_vac is None else k_vac).shape
+        left = np.empty((num_layers,) + shape + (2, 2), dtype=complex)
+        right = np.empty((num_layers,) + shape + (2, 2), dtype=complex)
+        left[0] = right[-1] = [[0, 1], [1, 0]]
+        left[1] = self.i_smatrix_batch(0, 1, n_11, pol, field)
+        right[-2] = self.i_smatrix_batch(num_layers - 2, num_layers - 1, n_11, pol, field)
+        for j in range(1, num_layers - 1):
+            p = self.p_smatrix_batch(j, n_11, k_vac)
+            i = self.i_smatrix_batch(j, j + 1, n_11, pol, field)
+            left[j + 1] = redheffer(redheffer(left[j], p), i)
+        for j in range(num_layers - 3, -1, -1):
+            p = self.p_smatrix_batch(j + 1, n_11, k_vac)
+            i = self.i_smatrix_batch(j, j + 1, n_11, pol, field)
+            right[j] = redheffer(i, redheffer(p, right[j + 1]))
+        return left, right
+
+    def _partial_s_matrices(self, n_11, pol=None, field=None, k_vac=None):
+        """
+        Partial scattering matrices (see partial_scattering_matrices_batch) using the structure's formalism.
+        The last few results are cached so that e.g. lower and upper incidence, or every layer of the
+        structure, share a single set of partial matrices for the same n_11 array.
+        """
+        pol = self.pol if pol is None else pol
+        field = self.field if field is None else field
+        n_11 = np.asarray(n_11)
+        k_vac = self.k_vac if k_vac is None else np.asarray(k_vac)
+        key = (pol, field, self.formalism, n_11.shape, n_11.tobytes(), np.shape(k_vac), np.asarray(k_vac).tobytes())
+        cache = self._partials_cache
+        # Keyed on the content of the layer stack, so in-place edits of d_list or n_list are picked up
+        if cache.get('d_list') != self.d_list.tobytes() or cache.get('n_list') != self.n_list.tobytes():
+            cache = self._partials_cache = {'d_list': self.d_list.tobytes(), 'n_list': self.n_list.tobytes()}
+        if key not in cache:
+            if self.formalism == 'scattering':
+                partials = self.partial_scattering_matrices_batch(n_11, pol, field, k_vac)
+            else:
+                prefix, suffix = self.partial_matrices_batch(n_11, pol, field, k_vac)
+                partials = t_to_s(prefix), t_to_s(suffix)
+            # Keep the two most recent sets (e.g. TE and TM) on top of the structure identity
+            while len(cache) > 3:
+                del cache[next(k for k in cache if k not in ['d_list', 'n_list'])]
+            cache[key] = partials
+        return cache[key]
+
+    def partial_matrices_batch(self, n_11, pol=None, field=None, k_vac=None):
+        """
+        Returns all the partial system transfer matrices for an array of n_11 values in one O(L) pass.
+        prefix[j] is s_prime for layer j (j >= 1) and suffix[j] is s_dprime for layer j (j <= num_layers - 2),
+        so prefix[-1] is the total system matrix s. The unused prefix[0] and suffix[-1] are identities.
+        Both arrays have shape (num_layers,) + broadcast(n_11, k_vac).shape + (2, 2).
+        """
+        num_layers = self.num_layers
+        shape = np.broadcast(n_11, self.k_vac if k_vac is None else k_vac).shape
+        prefix = np.empty((num_layers,) + shape + (2, 2), dtype=complex)
+        suffix = np.empty((num_layers,) + shape + (2, 2), dtype=complex)
+        prefix[0] = suffix[-1] = np.identity(2)
+        prefix[1] = self.i_matrix_batch(0, 1, n_11, pol, field)
+        suffix[-2] = self.i_matrix_batch(num_layers - 2, num_layers - 1, n_11, pol, field)
+        for j in range(1, num_layers - 1):
+            l = self.l_matrix_batch(j, n_11, k_vac)
+            i = self.i_matrix_batch(j, j + 1, n_11, pol, field)
+            prefix[j + 1] = prefix[j] @ l @ i
+        for j in range(num_layers - 3, -1, -1):
+            l = self.l_matrix_batch(j + 1, n_11, k_vac)
+            i = self.i_matrix_batch(j, j + 1, n_11, pol, field)
+            suffix[j] = i @ (l @ suffix[j + 1])
+        return prefix, suffix
+
+    def layer_field_amplitudes_batch(self, n_11, pol=None, field=None, k_vac=None, incidence='Lower'):
+        """
+        Evaluate fwd and bkwd field amplitude coefficients (E or H) in every layer for an array of n_11
+        values from a single set of partial matrices (see layer_field_amplitudes for the conventions).
+        Returns (field_plus, field_minus), each of shape (num_layers,) + broadcast(n_11, k_vac).shape.
+
+        incidence='Upper' gives the leaky modes incident from the upper cladding (RHS) instead, in units of
+        the incoming (bkwd) wave amplitude at the last boundary. Both use the same partial matrices, so the
+        structure never needs to be flipped.
+        """
+        assert incidence in ['Lower', 'Upper'], ValueError('Incidence option must be either "Upper" or "Lower".')
+        k_vac = self.k_vac if k_vac is None else k_vac
+        left, right = self._partial_s_matrices(n_11, pol, field, k_vac)
+        return self._field_amplitudes_from_s(left, right, n_11, k_vac, incidence)
+
+    def _field_amplitudes_from_s(self, left, right, n_11, k_vac, incidence='Lower'):
+        """
+        Field amplitudes of every layer from the partial scattering matrices of _partial_s_matrices.
+        """
+        n = self.n_list.real
+        # Reflection and transmission of the whole structure
+        r = left[-1, ..., 0, 0]
+        t = left[-1, ..., 1, 0]
+        # Broadcast the layer properties against the n_11 (and k_vac) axes
+        axes = (-1,) + (1,) * (left.ndim - 3)
+        n_11 = np.asarray(n_11)
+        q = np.array([self.calc_xi_batch(j, n_11) for j in range(self.num_layers)])
+        q = q.reshape(q.shape[:1] + (1,) * (len(axes) - q.ndim) + q.shape[1:]) * k_vac
+        d = self.d_list.reshape(axes)
+
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            # Leaky modes: incoming wave incident on the LHS of structure
+            t_prime = left[..., 1, 0]
+            r_prime_minus = left[..., 1, 1]
+            r_dprime = right[..., 0, 0]
+            phase = exp(1j * 2 * q * d)
+            leaky_plus = t_prime / (1 - r_prime_minus * r_dprime * phase)
+            leaky_minus = leaky_plus * r_dprime * phase
+            leaky_plus[0] = 1
+            leaky_minus[0] = r
+            leaky_plus[-1] = t
+            leaky_minus[-1] = 0
+
+            if incidence == 'Upper':
+                # Leaky modes: incoming wave incident on the RHS of structure
+                t_dprime_minus = right[..., 0, 1]
+                leaky_minus = t_dprime_minus / (1 - r_dprime * r_prime_minus * phase) * exp(1j * q * d)
+                leaky_plus = r_prime_minus * leaky_minus
+                leaky_plus[0] = 0
+                leaky_minus[0] = left[-1, ..., 0, 1]
+                leaky_plus[-1] = left[-1, ..., 1, 1]
+                leaky_minus[-1] = 1
+
+            # Guided modes: 2 outgoing waves, no incoming, in terms of the superstrate (j=0) outgoing wave
+            guided_minus = 1 / left[..., 0, 1]
+            guided_plus = r_prime_minus * guided_minus
+            guided_plus[0] = 0
+            guided_minus[0] = 1
+            guided_plus[-1] = t / r
+            guided_minus[-1] = 0
+
+        radiative = n_11.real < max(n[0], n[-1])
+        field_plus = np.where(radiative, leaky_plus, guided_plus)
+        field_minus = np.where(radiative, leaky_minus, guided_minus)
+        return field_plus, field_minus
+
     def layer_field_amplitudes(self, layer):
         """
         Evaluate fwd and bkwd field amplitude coefficients (E or H) in a layer.
         Coefficients are in units of the fwd incoming wave amplitude for leaky modes
         and in terms of the superstrate (j=0) outgoing wave amplitude for guided modes.
+
+        The amplitudes of all layers are evaluated together and cached, so evaluating every
+        layer for the same n_11, polarisation, field and wavelength costs a single O(L) pass.
         """
-        n = self.n_list.real
-        if self.n_11 < max(n[0], n[-1]):  # Mode is radiative
-            # Calculate leaky amplitudes
-            s = self.s_matrix()
-            # Reflection for incoming wave incident of LHS of structure
-            r = s[1, 0] / s[0, 0]
-            if layer == 0:
-                field_plus = 1 + 0j
-                field_minus = r
-            elif layer == self.num_layers - 1:
-                field_plus = 1 / s[0, 0]
-                field_minus = 0 + 0j
-            else:
-                q = self.calc_q(layer)
-                d = self.d_list[layer]
-
-                s_prime = self.s_primed_matrix(layer)
-                s_dprime = self.s_dprimed_matrix(layer)
-                t_prime = 1 / s_prime[0, 0]
-                r_prime_minus = -s_prime[0, 1] / s_prime[0, 0]
-                r_dprime = s_dprime[1, 0] / s_dprime[0, 0]
-
-                field_plus = t_prime / (1 - r_prime_minus * r_dprime * exp(1j * 2 * q * d))
-                field_minus = field_plus * r_dprime * exp(1j * 2 * q * d)
-        else:  # Calculate guided amplitudes (2 outgoing waves no incoming)
-            if layer == 0:
-                field_plus = 0 + 0j
-                field_minus = 1 + 0j
-            elif layer == self.num_layers - 1:
-                s = self.s_matrix()
-                field_plus = 1 / s[1, 0]
-                field_minus = 0 + 0j
-            else:
-                s_prime = self.s_primed_matrix(layer)
-                assert not np.isclose(det(s_prime), 0), ValueError('Det=0 will give inf for field coefficient.')
-                field_plus = - s_prime[0, 1] / det(s_prime)
-                field_minus = s_prime[0, 0] / det(s_prime)
-        return field_plus, field_minus
+        # Keyed on the content of the layer stack, so in-place edits of d_list or n_list are picked up
+        key = (self.n_11, self.pol, self.field, self.k_vac, self.formalism, self.d_list.tobytes(),
+               self.n_list.tobytes())
+        cache = self._amplitude_cache
+        if cache is None or cache['key'] != key:
+            left, right = self._partial_s_matrices(self.n_11)
+            field_plus, field_minus = self._field_amplitudes_from_s(left, right, self.n_11, self.k_vac)
+            cache = {'key': key, 'left': left, 'field_plus': field_plus, 'field_minus': field_minus}
+            self._amplitude_cache = cache
+        if np.real(self.n_11) >= max(self.n_list[0].real, self.n_list[-1].real) and 0 < layer < self.num_layers - 1:
+            # det(s_prime) = t_prime_minus / t_prime
+            s_prime = cache['left'][layer]
+            assert not np.isclose(s_prime[0, 1] / s_prime[1, 0], 0), \
+                ValueError('Det=0 will give inf for field coefficient.')
+        return cache['field_plus'][layer], cache['field_minus'][layer]
+
+    def calc_field_profile(self):
+        """
+        Return the analytic field (E or H) profile of the structure for the current n_11, polarisation, field
+        and wavelength as a FieldProfile, which holds only the field amplitudes (see layer_field_amplitudes)
+        and perpendicular wave vector of every layer and evaluates the field lazily at any z.
+        """
+        field_plus, field_minus = zip(*(self.layer_field_amplitudes(j) for j in range(self.num_layers)))
+        q = np.array([self.calc_q(j) for j in range(self.num_layers)])
+        return FieldProfile(self.d_list, self.n_list, self.lam_vac, self.n_11, q, field_plus, field_minus,
+                            self.pol, self.field)
 
     def calc_layer_field(self, layer, z_step=1):
         """
         Evaluate the field (E or H) as a function of z (depth) into the layer, j.
         field_plus is the forward component of the field (e.g. E_j^+)
         field_minus is the backward component of the field (e.g. E_j^-)
+        Sampled from calc_field_profile, which evaluates the field at any z.
         """
         assert self.d_list[layer] > 0, ValueError('Layer must have a thickness to use this function.')
 
-        # Wave vector components in layer
-        k, q, k_11 = self.calc_wave_vector_components(layer)
-
         # z positions to evaluate field at at
         z = np.arange((z_step / 2.0), self.d_list[layer], z_step)
         # Note field_plus and field_minus are defined at cladding-layer boundary so need to
@@ -284,42 +693,21 @@ class TransferMatrix:
             z = -z[::-1]
 
         # field(z) field in terms of incident field amplitude
-        field_plus, field_minus = self.layer_field_amplitudes(layer)
-        field = field_plus * exp(1j * q * z) + field_minus * exp(-1j * q * z)
+        profile = self.calc_field_profile()
+        field = profile.layer_field(layer, z)
         field_squared = abs(field) ** 2
 
-        # average value of the field_squared
-        field_avg = sum(field_squared) / (z_step * self.d_list[layer])
+        # average value of the field_squared over the layer (exact, independent of z_step)
+        field_avg = profile.layer_average(layer)
 
         return {'z': z, 'field': field, 'field_squared': field_squared, 'field_avg': field_avg}
 
     def calc_field_structure(self, z_step=1):
         """
         Evaluate the field at all z positions within the structure.
+        Sampled from calc_field_profile, which evaluates the field at any z.
         """
-        z = np.arange((z_step / 2.0), self.d_cumulative[-1], z_step)
-        # get z_mat - specifies what layer the corresponding point in z is in
-        comp1 = np.kron(np.ones((self.num_layers, 1)), z)
-        comp2 = np.transpose(np.kron(np.ones((len(z), 1)), self.d_cumulative))
-        z_mat = sum(comp1 > comp2, 0)
-
-        field = np.zeros(len(z), dtype=complex)
-        # Loop through all layers with a thickness (claddings with 0 thickness will not show in z_mat)
-        for layer in range(min(z_mat), max(z_mat) + 1):
-            # logging.info simulation information to command line
-            if layer == 0:
-                logging.info('\tLayer -> lower cladding...')
-            elif layer == self.num_layers - 1:
-                logging.info('\tLayer -> upper cladding...')
-            else:
-                logging.info('\tLayer -> internal {0:d} / {1:d}...'.format(layer, self.num_layers - 2))
-            time.sleep(0.2)  # Fixes progress bar occurring before text
-
-            # Calculate z indices inside structure for the layer
-            z_indices = np.where(z_mat == layer)
-            field[z_indices] = self.calc_layer_field(layer)['field']
-        field_squared = abs(field) ** 2
-        return {'z': z, 'field': field, 'field_squared': field_squared}
+        return self.calc_field_profile().sample(z_step)
 
     def get_layer_position_indices(self, layer, z_step=1):
         """Return z array indices for a chosen layer."""
@@ -331,60 +719,126 @@ class TransferMatrix:
         return np.where(z_mat == layer)
 
     def calc_s11(self, n_11):
-        """Return s_11 of s-matrix for a given n_11."""
+        """Return s_11 of s-matrix for a given n_11 (scaled, see calc_s11_batch)."""
         self.n_11 = n_11
-        s = self.s_matrix()
-        return s[0, 0].real
+        return self.calc_s11_batch(n_11)
+
+    def calc_s11_batch(self, n_11, pol=None, field=None, real=True):
+        """
+        Return s_11 of the s-matrix for an array of n_11 values in one vectorized pass.
+        Only the real part is returned unless real=False (e.g. for complex n_11). The real part is scaled by
+        exp(-|Im(q_j)| d_j) of every layer: a positive factor, so it has the sign and roots of s_11, but it stays
+        bounded (s_11 = 1/t overflows for thick claddings in either formalism).
+        """
+        if real:
+            return self.s_matrix_batch(n_11, pol, field, scaled=True)[..., 0, 0].real
+        if self.formalism == 'scattering':
+            r, t = self.calc_r_and_t_batch(n_11, pol, field)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                s_11 = 1 / t
+        else:
+            s_11 = self.s_matrix_batch(n_11, pol, field)[..., 0, 0]
+        return s_11
 
-    def calc_guided_modes(self, verbose=True, normalised=False):
+    @cached(light=('pol', 'field'))
+    def calc_guided_modes(self, verbose=True, normalised=False, as_objects=False):
         """
         Return the parallel wave vectors (k_11 or beta) of all guided modes that the structure
         supports. Array returned is arranged from lowest mode to highest mode.
 
         If normalised=True return (k_ll/k_vac = n_11)
+        If as_objects=True return a list of GuidedMode objects instead, holding the n_11, group velocity,
+        polarisation and normalised field amplitudes of every layer of each mode.
 
         Method: Evaluates the poles of the transfer matrix (S_11=0) as a function of n_11 in the
         guided regime:  n_clad < k_ll/k < max(n), k_11/k = n_11
+        s_11 is evaluated on a whole (adaptively refined) grid of n_11 at once and only the
+        sign changes are polished with brentq.
         """
         n = self.n_list.real
         assert self.supports_guiding(), ValueError('This structure does not support wave guiding.')
+        n_clad = max(n[0], n[-1])
+        # Grid with ~50 points per mode, estimated from the transverse phase thickness of the layers
+        phase = np.sum(self.d_list * self.k_vac * sqrt(np.clip(n ** 2 - n_clad ** 2, 0, None))) / pi
+        num = max(1000, 50 * int(phase))
         # Find supported guiding modes - max(n_clad) > n_11 >= max(n)
-        n_11 = roots(self.calc_s11, 1 * max(n[0], n[-1]), max(n), verbose=verbose)
+        # s_11 is not finite at n_clad itself, so start just above it to bracket modes close to cutoff
+        n_11 = grid_roots(self.calc_s11_batch, n_clad + 1e-9, max(n), num=num, verbose=verbose)
         # Flip array to arrange from lowest to highest mode (highest to lowest n_11)
         n_11 = n_11[::-1]
 
         ind = np.where(n_11 - min(n) < 0.01)
         n_11 = np.delete(n_11, ind)
 
-        if normalised:
+        if as_objects:
+            v_g = self.calc_group_velocity(n_11)
+            return [GuidedMode.from_structure(self, x, v) for x, v in zip(n_11, v_g)]
+        elif normalised:
             return n_11
         else:
             return n_11 * self.k_vac
 
-    def calc_group_velocity(self):
-        """
-        Calculate the group velocity of the structure at lam_vac for guided modes.
+    def calc_guided_modes_complex(self, n_11_lower=None, n_11_upper=None, verbose=True, normalised=False,
+                                  as_objects=False):
         """
-        lam_vac = self.lam_vac
+        Return the complex parallel wave vectors (k_11 or beta) of the guided modes of the structure,
+        including lossy modes of absorbing structures and surface plasmons on metal layers.
+        Array returned is arranged from lowest mode to highest mode (highest to lowest real n_11).
 
-        # Take lambda+-1 either side of the emission wavelength
-        self.set_vacuum_wavelength(int(1 + lam_vac))
-        omega1 = self.omega
-        beta_lower = self.calc_guided_modes(verbose=False, normalised=False)
-
-        self.set_vacuum_wavelength(int(-1 + lam_vac))
-        omega2 = self.omega
-        beta_upper = self.calc_guided_modes(verbose=False, normalised=False)
+        If normalised=True return (k_ll/k_vac = n_11)
+        If as_objects=True return a list of GuidedMode objects instead (see calc_guided_modes), e.g. for the
+        guided mode emission rates of lossy structures.
+
+        Method: The zeros of the (analytic) s_11(n_11) are searched for inside the rectangle of the
+        complex n_11 plane with corners n_11_lower and n_11_upper. Zeros are counted and located with
+        contour integrals (argument principle, Delves-Lyness) and polished with Newton's method, so the
+        cost does not depend on a fine real-axis grid. By default the rectangle spans
+        max(n_clad) < Re(n_11) < max(Re(n)) + 0.5 and -0.01 < Im(n_11) < 0.1; widen it for very lossy modes.
+        """
+        n = self.n_list
+        n_clad = max(n[0].real, n[-1].real)
+        if n_11_lower is None:
+            n_11_lower = complex(n_clad + 1e-6, -0.01)
+        if n_11_upper is None:
+            n_11_upper = complex(max(n.real) + 0.5, 0.1)
+        assert n_11_lower.real >= n_clad, ValueError('Guided modes must have Re(n_11) > max(n_clad).')
+        if verbose:
+            logging.info('The complex roots in [{}, {}] are:'.format(n_11_lower, n_11_upper))
+
+        n_11 = contour_roots(lambda x: self.calc_s11_batch(x, real=False), n_11_lower, n_11_upper, verbose=verbose)
+        # Arrange from lowest to highest mode (highest to lowest n_11)
+        n_11 = n_11[np.argsort(-n_11.real)]
+        if np.all(np.isreal(n)):
+            # Lossless structure: discard round-off imaginary parts
+            n_11 = np.real_if_close(n_11, tol=1e6)
+
+        if as_objects:
+            v_g = self.calc_group_velocity(n_11)
+            return [GuidedMode.from_structure(self, x, v) for x, v in zip(n_11, v_g)]
+        elif normalised:
+            return n_11
+        else:
+            return n_11 * self.k_vac
 
-        assert len(beta_lower) == len(beta_upper), \
-            ValueError('Number of guided modes must be equal when calculating the group velocity.')
+    def calc_group_velocity(self, n_11=None):
+        """
+        Calculate the group velocity of the structure at lam_vac for guided modes.
+        n_11 are the (normalised) guided modes; they are found with calc_guided_modes if not given.
 
-        d_beta = beta_upper - beta_lower
-        d_omega = omega2 - omega1
-        vg = d_omega / d_beta
+        Method: Implicit differentiation of the guided mode condition s_11(n_11, k_vac) = 0:
+        dn_11/dk_vac = -(ds_11/dk_vac) / (ds_11/dn_11), with the derivatives propagated analytically through
+        the (scaled, so thick claddings do not overflow) transfer matrices (see s_matrix_derivatives_batch),
+        so v_g = c / (n_11 + k_vac dn_11/dk_vac). The refractive indices are taken to be non dispersive.
+        """
+        if n_11 is None:
+            n_11 = self.calc_guided_modes(verbose=False, normalised=True)
+        n_11 = np.asarray(n_11)
+        s, s_n, s_k = self.s_matrix_derivatives_batch(n_11, scaled=True)
+        dn_11_dk = -s_k[..., 0, 0] / s_n[..., 0, 0]
+        vg = c / (n_11 + self.k_vac * dn_11_dk)
+        if not np.iscomplexobj(n_11):
+            vg = vg.real
         logging.debug(vg)
-        # Reset the vacuum emission wavelength to start of function
-        self.set_vacuum_wavelength(lam_vac)
         return vg
 
     def get_layer_boundaries(self):
@@ -412,6 +866,9 @@ class TransferMatrix:
         """
         Return the complex reflection and transmission coefficients of the structure.
         """
+        if self.formalism == 'scattering':
+            s = self.scattering_matrix_batch(self.n_11)
+            return s[0, 0], s[1, 0]
         s = self.s_matrix()
         r = s[1, 0] / s[0, 0]
         t = 1 / s[0, 0]
@@ -437,20 +894,11 @@ class TransferMatrix:
 
     def calc_reflectivity_vs_angle(self, th_lower=0, th_upper=90, num=1E4, plot=True):
         """ Reflection vs AOI"""
-        th_init = self.th
-        th_list = np.linspace(th_lower, th_upper, num, endpoint=False)
-        rs_list = []
-        rp_list = []
-        for theta in th_list:
-            self.set_incident_angle(theta, units='degrees')
-            self.set_polarization('s')
-            rs, t = self.calc_r_and_t()
-            rs_list.append(rs)
-            self.set_polarization('p')
-            rp, t = self.calc_r_and_t()
-            rp_list.append(rp)
-        rs_list = np.array(rs_list)
-        rp_list = np.array(rp_list)
+        th_list = np.linspace(th_lower, th_upper, int(num), endpoint=False)
+        # Evaluate all angles for both polarisations in one vectorized pass
+        n_11 = self.n_list[0] * sin(np.deg2rad(th_list))
+        rs_list, t = self.calc_r_and_t_batch(n_11, pol='s')
+        rp_list, t = self.calc_r_and_t_batch(n_11, pol='p')
 
         if plot:
             fig, (ax1, ax2) = plt.subplots(2, sharex='row')
@@ -468,7 +916,6 @@ class TransferMatrix:
             ax1.legend()
             ax2.legend()
             plt.show()
-            self.set_incident_angle(th_init, units='degrees')
             return {'th_list': th_list, 'rs_list': rs_list, 'rp_list': rp_list, 'fig': fig}
         else:
             return {'th_list': th_list, 'rs_list': rs_list, 'rp_list': rp_list}
@@ -478,19 +925,11 @@ class TransferMatrix:
         Dependence of the power reflectivity and phase on the angle of incidence.
         Light incident from medium of refractive index n1 to medium of refractive index n2
         """
-        th_list = np.linspace(th_lower, th_upper, num, endpoint=False)
-        ts_list = []
-        tp_list = []
-        for theta in th_list:
-            self.set_incident_angle(theta, units='degrees')
-            self.set_polarization('s')
-            rs, ts = self.calc_r_and_t()
-            ts_list.append(ts)
-            self.set_polarization('p')
-            rp, tp = self.calc_r_and_t()
-            tp_list.append(tp)
-        ts_list = np.array(ts_list)
-        tp_list = np.array(tp_list)
+        th_list = np.linspace(th_lower, th_upper, int(num), endpoint=False)
+        # Evaluate all angles for both polarisations in one vectorized pass
+        n_11 = self.n_list[0] * sin(np.deg2rad(th_list))
+        rs_list, ts_list = self.calc_r_and_t_batch(n_11, pol='s')
+        rp_list, tp_list = self.calc_r_and_t_batch(n_11, pol='p')
 
         if plot:
             fig, (ax1, ax2) = plt.subplots(2, sharex='row')
@@ -514,19 +953,10 @@ class TransferMatrix:
     def calc_reflectivity_vs_wavelength(self, lam_lower=500, lam_upper=1500, num=1000, plot=True):
         """ Reflection coefficient vs lam0"""
 
-        lam_init = self.lam_vac
         lam_list = np.linspace(lam_lower, lam_upper, num, endpoint=True)
-        rs_list = []
-        rp_list = []
-        for lam in lam_list:
-            # Do calculations
-            self.set_vacuum_wavelength(lam)
-            self.set_polarization('s')
-            r, t = self.calc_reflectance_and_transmittance(correction=False)
-            rs_list.append(r)
-            self.set_polarization('p')
-            r, t = self.calc_reflectance_and_transmittance(correction=False)
-            rp_list.append(r)
+        spectrum = self.calc_spectrum(lam_list, self.th, units='radians', correction=False)
+        rs_list = spectrum['R_s']
+        rp_list = spectrum['R_p']
 
         if plot:
             fig, ax = plt.subplots()
@@ -537,9 +967,50 @@ class TransferMatrix:
             plt.legend()
             plt.show()
 
-        self.set_vacuum_wavelength(lam_init)
         return lam_list, rs_list, rp_list
 
+    @cached
+    def calc_spectrum(self, lam_vac, th=0, units='degrees', correction=True):
+        """
+        Return the reflectance (R), transmittance (T) and complex reflection (r) and transmission (t)
+        coefficients of the structure for both polarisations over an array of vacuum wavelengths.
+        All wavelengths (and angles) are evaluated together in one vectorized pass per polarisation.
+
+        If th is an array of angles of incidence the results are (lambda, theta) maps of shape
+        (len(lam_vac), len(th)), otherwise they have shape (len(lam_vac),).
+        Correction option for transmission due to beam expansion (as calc_reflectance_and_transmittance).
+        The structure's vacuum wavelength, angle and polarisation are left unchanged.
+        """
+        lam_vac = np.asarray(lam_vac, dtype=float)
+        assert lam_vac.ndim == 1, ValueError('lam_vac must be a 1D array of wavelengths.')
+        assert np.all(lam_vac > 0), ValueError('Wavelength must > 0.')
+        assert self.num_layers > 0, ValueError('Define the structure first before using this function.')
+        if units == 'degrees':
+            th = np.deg2rad(th)
+        elif units != 'radians':
+            raise ValueError('Units of angle not recognised. Please enter \'radians\' or \'degrees\'.')
+        assert np.all((0 <= th) & (th < pi / 2)), 'The light is not incident on the structure. ' \
+                                                  'Check input theta satisfies 0 <= theta < pi/2'
+        # Broadcast wavelengths down the rows and angles along the columns
+        k_vac = 2 * pi / lam_vac
+        n_11 = self.n_list[0] * sin(np.asarray(th, dtype=float))
+        if np.ndim(th) > 0:
+            k_vac = k_vac[:, None]
+
+        result = {'lam_vac': lam_vac, 'th': th}
+        for pol in ['s', 'p']:
+            r, t = self.calc_r_and_t_batch(n_11, pol=pol, field='E', k_vac=k_vac)
+            reflectance = abs(r) ** 2
+            transmittance = abs(t) ** 2
+            if correction:
+                # n_2 cos(th_2) / n_1 cos(th_1), zero for total internal reflection
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    xi_1 = self.calc_xi_batch(0, n_11)
+                    xi_2 = self.calc_xi_batch(self.num_layers - 1, n_11)
+                    transmittance *= xi_2.real / xi_1.real
+            result.update({'R_' + pol: reflectance, 'T_' + pol: transmittance, 'r_' + pol: r, 't_' + pol: t})
+        return result
+
     def calc_absorption(self):
         n = self.n_list
         # Absorption coefficient in 1/cm
@@ -555,6 +1026,8 @@ class TransferMatrix:
         self.d_list = self.d_list[::-1]
         self.n_list = self.n_list[::-1]
         self.d_cumulative = np.cumsum(self.d_list)
+        self.periods = [(self.num_layers - start - cell_len * num_periods, cell_len, num_periods)
+                        for start, cell_len, num_periods in self.periods]
         logging.info('WARNING: Rerun set_incident_angle() function before doing the calculations to recalculate n_11.')
 
     def info(self):
@@ -614,8 +1087,8 @@ class TransferMatrix:
 
     def mode_type(self):
         # See Quantum Electronics by Yariv pg.603
-        n = self.n_list
-        if len(n) > 2 and max(n[1:-1]) >= self.n_11 >= min(n[0], n[-1]):
+        n = self.n_list.real
+        if len(n) > 2 and max(n[1:-1]) >= np.real(self.n_11) >= min(n[0], n[-1]):
             return 'Guided'
         else:
             return 'Leaky'